@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics probe network soak benchmark
+#  File : bench_fleet.py
+#
+#  Install: sudo pip3 install pyserial docopt
+# ----------------------------------------------------------------------
+"""bench_fleet by ecometer snc.
+
+Usage:
+    bench_fleet.py [options]
+    bench_fleet.py (-h | --help)
+
+    probe_net get_net_data polling cycles on simulated buses (probe_sim,
+    POSIX pty), for growing fleets. Probes are spread evenly over the
+    ports, simulators run in a child process.
+
+    Each cycle: seconds, records downloaded and records/second, probes
+    failed, CPU seconds and percent of the polling process, its RSS.
+
+Options:
+    -h --help               Show this screen.
+    -f, --fleet=<n,..>      Fleet sizes, probes [default: 1,10,50,100,200].
+    -p, --ports=<n>         Simulated ports [default: 4].
+    -c, --cycles=<n>        Polling cycles by fleet size [default: 3].
+    -r, --records=<n>       Records downloaded by probe and cycle [default: 20].
+    -s, --sensors=<n>       Probe sensors 3|5 [default: 5].
+    -t, --turnaround=<s>    Probe turnaround, seconds [default: 0.005].
+    -b, --byte-time=<s>     Seconds per byte, line speed when empty [default: ].
+    -l, --loss=<p>          Probability of a command not heard [default: 0].
+    -e, --errors=<p>        Probability of a bcc error in an answer [default: 0].
+"""
+
+""" Imports
+"""
+import sys
+import os
+import time
+import logging
+import tempfile
+import multiprocessing
+import resource
+import serial
+from docopt import docopt
+# ecometer modules
+import probe_net
+import probe_inventory
+import probe_sink
+import probe_sim
+
+
+""" Simulated fleet, child process
+"""
+# buses for the layout, ports sent back, then commands: refill, stop
+def serve_fleet(conn, layout, sensors, records, options):
+    buses = []
+    for ids in layout:
+        probes = [probe_sim.VirtualProbe(id, sensors=sensors, records=records, interval=3600) for id in ids]
+        buses.append(probe_sim.PtyBus(probes, **options))
+    conn.send([bus.port for bus in buses])
+
+    while True:
+        command = conn.recv()
+        if command == 'refill':
+            # next L download gets the whole memory again
+            for bus in buses:
+                for probe in bus.probes.values():
+                    probe.pointer = 0
+            conn.send(True)
+        elif command == 'stop':
+            conn.send((sum(bus.commands for bus in buses), sum(bus.lost for bus in buses)))
+            for bus in buses:
+                bus.close()
+            return
+
+
+""" Process measures
+"""
+# CPU seconds of this process, all threads
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# resident set size (MB), peak when the current one is not available
+def rss():
+    try:
+        with open('/proc/self/statm') as the_file:
+            return int(the_file.read().split()[1]) * resource.getpagesize() / 1048576.0
+    except (IOError, OSError):
+        scale = 1048576.0 if sys.platform == 'darwin' else 1024.0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+""" Poll a fleet of probes for some cycles
+"""
+def bench_fleet(size, ports, cycles, records, sensors, options):
+    # ids 1..99 by bus
+    ports = min(ports, size)
+    layout = [[] for port in range(ports)]
+    for k in range(size):
+        layout[k % ports].append(k // ports + 1)
+    if max(len(ids) for ids in layout) > 99:
+        print("%d probes need more than %d ports" % (size, ports))
+        return
+
+    conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=serve_fleet, args=(child_conn, layout, sensors, records, options))
+    child.start()
+    try:
+        names = conn.recv()
+        data_path = tempfile.mkdtemp()
+        inventory = probe_inventory.Inventory(names[0], 9600)
+        for port, ids in zip(names, layout):
+            for id in ids:
+                inventory.add({'name': '%s-%02d' % (os.path.basename(port), id), 'id': id, 'sensors': sensors,
+                               'port': port, 'baud': 9600, 'interval': 3600})
+        conf = {
+            'port'     : names[0],
+            'baudrate' : 9600,
+            'parity'   : serial.PARITY_NONE,
+            'stopbits' : serial.STOPBITS_ONE,
+            'bytesize' : serial.EIGHTBITS
+        }
+        # records counted, not stored
+        sink = probe_sink.create_sink('null', data_path)
+
+        for cycle in range(cycles):
+            conn.send('refill')
+            conn.recv()
+            count = sink.count
+            cpu = cpu_time()
+            start = time.time()
+            results = probe_net.get_net_data(conf, data_path, inventory, sink)
+            elapsed = time.time() - start
+            cpu = cpu_time() - cpu
+            count = sink.count - count
+            failed = sum(1 for res in results.values() if not res)
+            print("%5d %5d %5d %8.1f %8d %8.0f %6d %8.2f %5.0f%% %8.1f" % (
+                size, ports, cycle + 1, elapsed, count, count / elapsed, failed, cpu, 100 * cpu / elapsed, rss()))
+            sys.stdout.flush()
+
+        sink.close()
+        conn.send('stop')
+        commands, lost = conn.recv()
+        logging.info("%d commands, %d lost" % (commands, lost))
+
+    finally:
+        child.join(5)
+        if child.is_alive():
+            child.terminate()
+
+
+""" Main script
+"""
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    # library logging, errors only
+    logging.VERBOSE = 5
+    logging.verbose = lambda msg, *args, **kwargs: logging.log(logging.VERBOSE, msg, *args, **kwargs)
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s-%(levelname)s: %(message)s')
+
+    options = {
+        'turnaround' : float(args['--turnaround']),
+        'byte_time'  : float(args['--byte-time']) if args['--byte-time'] else None,
+        'loss'       : float(args['--loss']),
+        'corruption' : float(args['--errors']),
+    }
+    print("probes ports cycle  seconds  records  rec/s   failed  cpu (s)   cpu  rss (MB)")
+    for size in [int(size) for size in args['--fleet'].split(',')]:
+        bench_fleet(size, int(args['--ports']), int(args['--cycles']), int(args['--records']), int(args['--sensors']), options)
+
+
+""" SAMPLES
+"""
+# bench_fleet.py
+# bench_fleet.py -f 10,50 -p 1 -c 1
+# bench_fleet.py -b 0 -l 0.01 -e 0.01
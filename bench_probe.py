@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics protocol micro-benchmarks
+#  File : bench_probe.py
+#
+#  Install: sudo pip3 install pyserial docopt
+# ----------------------------------------------------------------------
+"""bench_probe by ecometer snc.
+
+Usage:
+    bench_probe.py [options] (records|framing|bcc|format|write|all)
+    bench_probe.py (-h | --help)
+
+Arguments:
+    records         Data record decoding, records/second
+    framing         Frames cut from the receive buffer and parsed
+    bcc             Block check code of a record
+    format          Record line id;date time;values from decoded fields
+    write           Record lines written to the download file
+    all             All of them
+
+    Results: operations/second of the best run, x ratio to the first
+    (legacy) variant, memory blocks and bytes allocated per operation
+    and still held by its result, peak bytes of one call by operation
+    (tracemalloc)
+
+Options:
+    -h --help           Show this screen.
+    -n, --number=<n>    Operations per run [default: 20000].
+    -r, --repeat=<n>    Runs, best one is reported [default: 5].
+"""
+
+""" Imports
+"""
+import sys
+import os
+import re
+import timeit
+import tracemalloc
+import tempfile
+import logging
+from docopt import docopt
+# ecometer modules
+import probe_bc_8340
+
+
+""" Recorded frames
+"""
+# 3 sensors, 4 values: livello, temperatura, conducibilità, pH
+RECORD_3 = b'SA8340- 20 4.3 27/06/18 11:50:00   0.002m      24.27\xf8C    -0.001mS    -2.200pH   27/06/18CE'
+# 4 values: livello, temperatura, conducibilità, pH
+RECORD_4 = b'SA8340- 00 5.1 29/03/17 14:03:00   0.002m      27.54\xf8C    -0.001mS     6.612pH   28/03/17C4'
+# 5 values: livello, temperatura, conducibilità, pH, redox
+RECORD_5 = b'SA8340- 00 4.5 05/09/17 03:52:00  -0.005m      25.27\xf8C     0.001mS     0.280pH     429.1mV   05/09/17F1'
+# records by sensors
+RECORDS = ((3, RECORD_3), (4, RECORD_4), (5, RECORD_5))
+
+# menu walk, as answered to E and M
+MENU = [
+    b'SA8340- 00 LOG ON TIME 59m START           61',
+    b'SA8340- 00 REC INST.  1354 REC UTIL. 44433 23',
+    b'SA8340- 00 MAIN  B.    V                   21',
+    b'SA8340- 00 MAIN  B. 5.1V OK                2F',
+    b'SA8340- 00 TIME  22/03/17        13:38:52  2E',
+    b'SA8340- 00 LEVEL  0.007m                   02',
+    b'SA8340- 00 TEMP.  25.90\xf8C                  89',
+    b'SA8340- 00 COND. -0.001mS  T.REF:20 TC:2.1007',
+    b'SA8340- 00 pH     8.714pH  A:-0.22pH S: 98%09',
+    b'SA8340- 00 RT CONT.:   10 s                66',
+    b'SA8340- 00 TIMEOUT ON STARTPROFILE: 10m    17',
+    b'SA8340- 00     POWER ON                    4E',
+    b'SA8340- 00 SA8340 R2.63    ID: 00          51',
+    b'SA8340- 00 TRANSMISSION    BAUD RATE:  960023',
+]
+
+# data record regex as used by probe_download_data before the fixed layout decoder
+LEGACY_RECORD = {
+    4: r'(SA8340-\s(\d\d)\s(-?\d*(.\d+)?)\s(\d\d)\/(\d\d)\/(\d\d)\s(\d\d):(\d\d):(\d\d)\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+\d\d\/\d\d\/\d\d)(..)',
+    5: r'(SA8340-\s(\d\d)\s(-?\d*(.\d+)?)\s(\d\d)\/(\d\d)\/(\d\d)\s(\d\d):(\d\d):(\d\d)\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+\d\d\/\d\d\/\d\d)(..)',
+}
+
+
+""" Decoders
+"""
+# frames are bytes, legacy decoder worked on latin1 text
+def decode_legacy(response, sensors):
+    matches = re.match(LEGACY_RECORD[5 if sensors == 5 else 4], response.decode('latin1'))
+    date_time = '20'+matches.group(7)+'-'+matches.group(6)+'-'+matches.group(5)
+    date_time += ' '+matches.group(8)+':'+matches.group(9)+':'+matches.group(10)
+    return date_time.encode(), [matches.group(n).encode() for n in range(11, 11 + 2*sensors, 2)]
+
+def decode_regex(response, sensors):
+    matches = probe_bc_8340.RE_RECORD.match(response)
+    fields = matches.groupdict()
+    date_time = b'20%s-%s-%s %s:%s:%s' % (fields['year'], fields['month'], fields['day'], fields['hour'], fields['minute'], fields['second'])
+    return date_time, probe_bc_8340.RE_VALUE.findall(fields['values'])[:sensors]
+
+def decode_fixed(response, sensors):
+    fields = probe_bc_8340.parse_record(response)
+    date_time = b'20%s-%s-%s %s:%s:%s' % (fields['year'], fields['month'], fields['day'], fields['hour'], fields['minute'], fields['second'])
+    return date_time, fields['values'][:sensors]
+
+
+""" Framing
+"""
+# receive buffer holding a whole menu walk, frames cut and parsed one by one
+def frames_client():
+    client = probe_bc_8340.Client({'port': 'bench'}, tempfile.mkdtemp())
+    data = b''.join(frame + b'\r\n' for frame in MENU)
+    next_frame = client._Client__serial_next_frame
+    def cut():
+        client.rx_buffer[:] = data
+        client.rx_scan = 0
+        frame = next_frame()
+        while frame is not None:
+            probe_bc_8340.parse_frame(frame)
+            frame = next_frame()
+    return cut
+
+# whole answer decoded to text and split, as before the receive buffer
+def frames_split():
+    data = b''.join(frame + b'\r\n' for frame in MENU)
+    def cut():
+        for frame in data.decode('latin1').split('\r\n')[:-1]:
+            probe_bc_8340.parse_frame(frame.encode('latin1'))
+    return cut
+
+
+""" Bcc
+"""
+# xor of the chars one by one, as __get_bcc did
+def bcc_legacy(record):
+    bcc = 0
+    for char in record.decode('latin1'):
+        bcc = bcc ^ ord(char)
+    high, low = bcc >> 4, bcc & 0x0F
+    return ('{:X}'.format(high) + '{:X}'.format(low)).encode()
+
+
+""" Record line
+"""
+def format_legacy(id, date_time, values):
+    rec = id.decode() + ';' + date_time.decode() + ';' + ';'.join(value.decode() for value in values)
+    return rec.encode('latin1')
+
+def format_bytes(id, date_time, values):
+    return id + b';' + date_time + b';' + b';'.join(values)
+
+
+""" Download file
+"""
+# records joined in memory, one write at the end of the download
+def write_legacy(file_name, recs):
+    records = ''
+    for rec in recs:
+        rec = rec.decode('latin1')
+        if records == '':
+            records = rec
+        else:
+            records += '\r' + rec
+    with open(file_name, 'a') as the_file:
+        the_file.write(records)
+
+# records written as they come, fsync every SYNC_EVERY
+def write_writer(file_name, recs):
+    writer = probe_bc_8340.RecordWriter(file_name)
+    for rec in recs:
+        writer.write(rec)
+    writer.close()
+
+
+""" Run one benchmark, return operations/second of the best run
+    func runs ops operations per call
+"""
+def bench(func, number, repeat, ops=1):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return number * ops / best
+
+""" Memory blocks and bytes allocated per call with results kept, peak bytes of one call
+"""
+def allocations(func, number):
+    results = [None] * number
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        results[i] = func()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+
+    # working memory, freed or not
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return blocks / float(number), size / float(number), peak
+
+""" Report variants of one operation, must return the same result
+"""
+def report(title, variants, number, repeat, unit, ops=1):
+    print(title)
+    expected = variants[0][1]()
+    baseline = None
+    for name, func in variants:
+        if func() != expected:
+            print("  %-14s MISMATCH %s" % (name, func()))
+            continue
+        rate = bench(func, number // ops or 1, repeat, ops)
+        baseline = baseline or rate
+        blocks, size, peak = allocations(func, max(1, min(number, 2000) // ops))
+        print("  %-14s %10.0f %s/s  x%.1f  %5.1f blocks %6.0f bytes %8.0f peak/%s" % (name, rate, unit, rate / baseline, blocks / ops, size / ops, peak / float(ops), unit[:-1]))
+
+
+""" Data record decoding
+"""
+def bench_records(number, repeat):
+    decoders = [
+        ('legacy regex', decode_legacy),
+        ('grammar regex', decode_regex),
+        ('fixed columns', decode_fixed),
+    ]
+    for sensors, response in RECORDS:
+        variants = [(name, lambda func=func: func(response, sensors)) for name, func in decoders]
+        report("%d sensors record (%d chars)" % (sensors, len(response)), variants, number, repeat, 'records')
+
+""" Frames cut from the receive buffer and parsed
+"""
+def bench_framing(number, repeat):
+    variants = [
+        ('split text', frames_split()),
+        ('rx buffer', frames_client()),
+    ]
+    report("menu walk, %d frames" % len(MENU), variants, number, repeat, 'frames', len(MENU))
+
+""" Record bcc
+"""
+def bench_bcc(number, repeat):
+    for sensors, response in RECORDS:
+        body = response[:-2]
+        variants = [
+            ('char xor', lambda: bcc_legacy(body)),
+            ('get_bcc', lambda: probe_bc_8340.get_bcc(body)),
+        ]
+        report("%d sensors record bcc" % sensors, variants, number, repeat, 'records')
+
+""" Record line from decoded fields
+"""
+def bench_format(number, repeat):
+    for sensors, response in RECORDS:
+        date_time, values = decode_fixed(response, sensors)
+        variants = [
+            ('text concat', lambda: format_legacy(b'00', date_time, values)),
+            ('bytes concat', lambda: format_bytes(b'00', date_time, values)),
+        ]
+        report("%d sensors record line" % sensors, variants, number, repeat, 'records')
+
+""" Download file write, a full probe memory
+"""
+def bench_write(number, repeat):
+    path = tempfile.mkdtemp()
+    for sensors, response in RECORDS:
+        date_time, values = decode_fixed(response, sensors)
+        recs = [format_bytes(b'00', date_time, values)] * 1360
+        def run(write):
+            file_name = os.path.join(path, "SondaID-00.dat")
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            write(file_name, recs)
+            return os.path.getsize(file_name)
+        variants = [
+            ('text, at end', lambda: run(write_legacy)),
+            ('RecordWriter', lambda: run(write_writer)),
+        ]
+        report("%d sensors download, %d records" % (sensors, len(recs)), variants, len(recs) * 5, repeat, 'records', len(recs))
+
+
+""" Main script
+"""
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    number = int(args['--number'])
+    repeat = int(args['--repeat'])
+
+    # library logging, without output
+    logging.VERBOSE = 5
+    logging.verbose = lambda msg, *args, **kwargs: logging.log(logging.VERBOSE, msg, *args, **kwargs)
+    logging.getLogger('').setLevel(logging.CRITICAL)
+
+    if args['records'] or args['all']:
+        bench_records(number, repeat)
+    if args['framing'] or args['all']:
+        bench_framing(number, repeat)
+    if args['bcc'] or args['all']:
+        bench_bcc(number, repeat)
+    if args['format'] or args['all']:
+        bench_format(number, repeat)
+    if args['write'] or args['all']:
+        bench_write(number, repeat)
+
+
+""" SAMPLES
+"""
+# bench_probe.py records
+# bench_probe.py -n 100000 records
+# bench_probe.py -r 3 all
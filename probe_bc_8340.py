@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding=utf8
 # -*- coding: utf8 -*-
 # vim: set fileencoding=utf8 :
@@ -11,7 +11,7 @@
 #
 #  Date : 2017-08-12
 #
-#  Install: sudo pip3 install pyserial | pip install pyserial
+#  Install: sudo pip3 install pyserial
 # ----------------------------------------------------------------------
 """ http://www.bc-electronics.it/ita/home.php
     livello, temperatura, conducibilità, pH
@@ -22,17 +22,253 @@
 """
 import sys
 import os
+import json
 import logging
 import logging.config
 import time
 import re
+import calendar
+import select
+import threading
+import queue
 import serial
-from datetime import datetime
+from datetime import datetime, timedelta
+from operator import itemgetter
 from serial import SerialException
+# ecometer modules
+import probe_trace
 
 if __name__ == '__main__':
     sys.exit(1)
 
+#- ----------------------------------------------------------------------------
+#- protocol grammar
+#- ----------------------------------------------------------------------------
+# frame types
+FRAME_RECORD         = 'record'          # data record, also answer to A
+FRAME_LOG_ON_TIME    = 'log_on_time'
+FRAME_REC            = 'rec'
+FRAME_BATTERY        = 'battery'
+FRAME_TIME           = 'time'
+FRAME_LEVEL          = 'level'
+FRAME_TEMP           = 'temp'
+FRAME_COND           = 'cond'
+FRAME_PH             = 'ph'
+FRAME_REDOX          = 'redox'
+FRAME_RT_CONT        = 'rt_cont'
+FRAME_TIMEOUT        = 'timeout'
+FRAME_POWER          = 'power'
+FRAME_ID             = 'id'
+FRAME_BAUD           = 'baud'
+FRAME_CAL_ID         = 'cal_id'
+FRAME_CAL_DAY        = 'cal_day'
+FRAME_CAL_MONTH      = 'cal_month'
+FRAME_CAL_YEAR       = 'cal_year'
+FRAME_CAL_HOUR       = 'cal_hour'
+FRAME_CAL_MINUTE     = 'cal_minute'
+FRAME_CAL_LOG_ON     = 'cal_log_on'
+FRAME_CAL_LOG_FORMAT = 'cal_log_format'
+FRAME_CAL_LOG_VALUE  = 'cal_log_value'
+FRAME_CAL_BAUD       = 'cal_baud'
+FRAME_READY          = 'ready'
+FRAME_STOP           = 'stop'
+FRAME_COUNT          = 'count'
+FRAME_DOWNLOAD       = 'download'        # G|L echo
+
+# SA8340- 00 4.5 05/09/17 03:52:00  -0.005m      25.27øC     0.001mS     0.280pH     429.1mV   05/09/17F1
+# SA8340- 20 4.3 27/06/18 11:50:00   0.002m      24.27øC    -0.001mS    -2.200pH   27/06/18CE
+RE_RECORD = re.compile(
+    br'(?P<record>SA8340-\s(?P<id>\d\d)\s(?P<firmware>-?\d*(?:\.\d+)?)\s'
+    br'(?P<day>\d\d)/(?P<month>\d\d)/(?P<year>\d\d)\s(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)'
+    br'(?P<values>.*?)\s+\d\d/\d\d/\d\d)(?P<bcc>..)$')
+RE_VALUE = re.compile(br'-?\d*\.?\d+')
+# values cut from the fixed columns, space separated
+RE_RECORD_VALUES = re.compile(br'\s*-?\d*\.?\d+(?:\s+-?\d*\.?\d+)*\s*')
+
+# SA8340- 00 <body>, grammar keyed by the first 3 chars of body
+GRAMMAR = {
+    # SA8340- 00 LOG ON TIME 59m START           61
+    # SA8340- 00 LOG ON TIME 24h STOP   17h 14/0755
+    b'LOG' : [(FRAME_LOG_ON_TIME, re.compile(br'LOG\sON\sTIME\s+(?P<value>\d+)(?P<unit>m|h)\s(?P<state>START|STOP)'))],
+    # SA8340- 00 REC INST.  1354 REC UTIL. 44433 23
+    b'REC' : [(FRAME_REC, re.compile(br'REC\sINST\.\s+(?P<rec_inst>\d+)\sREC\sUTIL\.\s+(?P<rec_util>\d+)'))],
+    # SA8340- 00 MAIN  B. 5.1V OK                2F
+    b'MAI' : [(FRAME_BATTERY, re.compile(br'MAIN\s+B\.\s*(?P<voltage>\d+\.\d+)?V\s*(?P<status>[A-Z]+)?'))],
+    # SA8340- 00 TIMEOUT ON STARTPROFILE: 10m    17
+    # SA8340- 00 TIME  22/03/17        13:38:52  2E
+    b'TIM' : [(FRAME_TIMEOUT, re.compile(br'TIMEOUT\sON\sSTART\w*:\s*(?P<value>\d+)(?P<unit>[smh])')),
+             (FRAME_TIME, re.compile(br'TIME\s+(?P<day>\d\d)/(?P<month>\d\d)/(?P<year>\d\d)\s+(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)'))],
+    # SA8340- 00 LEVEL  0.007m                   02
+    b'LEV' : [(FRAME_LEVEL, re.compile(br'LEVEL\s+(?P<value>-?\d*\.?\d+)m'))],
+    # SA8340- 00 TEMP.  25.90øC                  89
+    b'TEM' : [(FRAME_TEMP, re.compile(br'TEMP\.\s+(?P<value>-?\d*\.?\d+)'))],
+    # SA8340- 00 COND. -0.001mS  T.REF:20 TC:2.1007
+    b'CON' : [(FRAME_COND, re.compile(br'COND\.\s+(?P<value>-?\d*\.?\d+)mS'))],
+    # SA8340- 00 pH     8.714pH  A:-0.22pH S: 98%09
+    b'pH ' : [(FRAME_PH, re.compile(br'pH\s+(?P<value>-?\d*\.?\d+)pH'))],
+    # SA8340- 01 REDOX-  41.0mV  A:   16mV S:100%42
+    b'RED' : [(FRAME_REDOX, re.compile(br'REDOX-?\s*(?P<value>-?\d*\.?\d+)mV'))],
+    # SA8340- 00 RT CONT.:   10 s                66
+    b'RT ' : [(FRAME_RT_CONT, re.compile(br'RT\sCONT\.:\s+(?P<value>\d+)\s?s'))],
+    # SA8340- 00     POWER ON                    4E
+    b'   ' : [(FRAME_POWER, re.compile(br'\s+POWER\s(?P<state>ON|OFF)'))],
+    # SA8340- 00 SA8340 R2.63    ID: 00          51
+    # SA8340- 00 SA8340 R2.63    CAL ID: 00
+    b'SA8' : [(FRAME_ID, re.compile(br'SA8340\s(?P<release>R\d\.\d\d)\s+ID:\s(?P<probe_id>\d\d)')),
+             (FRAME_CAL_ID, re.compile(br'SA8340\sR\d\.\d\d\s+CAL\sID:\s(?P<value>\d\d)'))],
+    # SA8340- 00 TRANSMISSION    BAUD RATE:  960023
+    b'TRA' : [(FRAME_BAUD, re.compile(br'TRANSMISSION\s+BAUD\sRATE.+?(?P<baud>1200|2400|4800|9600|19200)..$'))],
+    # SA8340- 00 CAL LOG:        ON TIME         34
+    # SA8340- 00 CAL LOG: T.INT   Minutes        54
+    # SA8340- 00 CAL LOG: T.INT   59m            68
+    b'CAL' : [(FRAME_CAL_DAY, re.compile(br'CAL\sTIME\s+DAY\s+(?P<value>\d\d)')),
+             (FRAME_CAL_MONTH, re.compile(br'CAL\sTIME\s+MON\.\s+(?P<value>\d\d)')),
+             (FRAME_CAL_YEAR, re.compile(br'CAL\sTIME\s+YEAR\s+(?P<value>\d\d)')),
+             (FRAME_CAL_HOUR, re.compile(br'CAL\sTIME\s+HOUR\s+(?P<value>\d\d)')),
+             (FRAME_CAL_MINUTE, re.compile(br'CAL\sTIME\s+MIN\.\s+(?P<value>\d\d)')),
+             (FRAME_CAL_LOG_ON, re.compile(br'CAL\sLOG:\s+ON\sTIME')),
+             (FRAME_CAL_LOG_FORMAT, re.compile(br'CAL\sLOG:\s+T\.INT\s+(?P<format>Minutes|Hours)')),
+             (FRAME_CAL_LOG_VALUE, re.compile(br'CAL\sLOG:\s+T\.INT\s+(?P<value>\d+)(?P<unit>m|h)')),
+             (FRAME_CAL_BAUD, re.compile(br'CAL\sTRANSMISSIONBAUD\sRATE:\s+(?P<value>\d+)..$'))],
+}
+
+# bcc as sent by the probe, by xor value
+BCC_HEX = [('%02X' % value).encode() for value in range(256)]
+
+# frames not starting with SA8340-
+RE_COUNT = re.compile(br'\s+(?P<count>\d+)')
+
+# record fixed layout, columns of RECORD_COLUMN chars after the time
+RECORD_HEADER = 32  # SA8340- 00 5.1 29/03/17 14:03:00
+RECORD_COLUMN = 12  #   0.002m    | 27.54øC    |  -0.001mS   | ...
+RECORD_TAIL   = 11  #    28/03/17C4 - space, date and bcc
+RECORD_FIELDS = ('record', 'id', 'firmware', 'day', 'month', 'year', 'hour', 'minute', 'second', 'bcc')
+RECORD_SLICES = itemgetter(slice(0, -2), slice(8, 10), slice(11, 14), slice(15, 17), slice(18, 20), slice(21, 23),
+                           slice(24, 26), slice(27, 29), slice(30, 32), slice(-2, None))
+RECORD_SEPARATORS = (b'/', b'/', b':', b':', b'/', b'/')
+RECORD_SEPARATOR_SLICES = itemgetter(slice(17, 18), slice(20, 21), slice(26, 27), slice(29, 30), slice(-8, -7), slice(-5, -4))
+# number right aligned in the first 8 chars of a column, unit follows
+RECORD_VALUE_SLICES = dict((n, itemgetter(*[slice(RECORD_HEADER + k*RECORD_COLUMN, RECORD_HEADER + k*RECORD_COLUMN + 8) for k in range(n)] + [slice(0, 0)]))
+                           for n in range(1, 7))
+
+""" Decode a data record frame (bytes) by its fixed layout, regex for odd lines
+"""
+def parse_record(response):
+    columns, remainder = divmod(len(response) - RECORD_HEADER - RECORD_TAIL, RECORD_COLUMN)
+    if remainder == 0 and columns in RECORD_VALUE_SLICES and RECORD_SEPARATOR_SLICES(response) == RECORD_SEPARATORS:
+        text = b' '.join(RECORD_VALUE_SLICES[columns](response))
+        values = text.split()
+        # numbers only, as the regex takes them
+        if len(values) == columns and RE_RECORD_VALUES.fullmatch(text):
+            fields = dict(zip(RECORD_FIELDS, RECORD_SLICES(response)))
+            fields['values'] = values
+            return fields
+
+    # odd line, fallback
+    matches = RE_RECORD.match(response)
+    if matches:
+        fields = matches.groupdict()
+        fields['values'] = RE_VALUE.findall(fields['values'])
+        return fields
+    return None
+
+""" Classify a probe frame (bytes), return (frame type, fields) or (None, None)
+"""
+def parse_frame(response):
+    if response.startswith(b'SA8340-'):
+        body = response[11:]
+        # data record, firmware version after id
+        if body[:1].isdigit():
+            fields = parse_record(response)
+            if fields is not None:
+                return FRAME_RECORD, fields
+            return None, None
+
+        for kind, regexpr in GRAMMAR.get(body[:3], ()):
+            matches = regexpr.match(body)
+            if matches:
+                return kind, matches.groupdict()
+        return None, None
+
+    if response.startswith(b'READY'):
+        return FRAME_READY, {}
+    if response.startswith(b'STOP'):
+        return FRAME_STOP, {}
+    if response[:1] in (b'G', b'L'):
+        return FRAME_DOWNLOAD, {'mode': response[:1]}
+    matches = RE_COUNT.match(response)
+    if matches:
+        return FRAME_COUNT, matches.groupdict()
+    return None, None
+
+
+""" Decode frame fields to text, at the output boundary
+"""
+def decode_fields(fields):
+    return dict((key, value.decode('latin1') if isinstance(value, bytes) else value) for key, value in fields.items())
+
+""" Get bcc code, xor of all bytes as 2 hex digits
+"""
+def get_bcc(data):
+    # fold the integer made of all bytes onto itself until one byte is left
+    size = len(data)
+    value = int.from_bytes(data, 'little')
+    while size > 1:
+        half = (size + 1) >> 1
+        shift = half << 3
+        value = (value & ((1 << shift) - 1)) ^ (value >> shift)
+        size = half
+    return BCC_HEX[value]
+
+# calibration values stepped with U/D: allowed values in U order, wrap around
+STEP_FIELDS = {
+    # days missing in the probe month are refused, no wrap around
+    FRAME_CAL_DAY       : (tuple(range(1, 32)), False),
+    FRAME_CAL_MONTH     : (tuple(range(1, 13)), True),
+    FRAME_CAL_YEAR      : (tuple(range(0, 100)), True),
+    FRAME_CAL_HOUR      : (tuple(range(0, 24)), True),
+    FRAME_CAL_MINUTE    : (tuple(range(0, 60)), True),
+    FRAME_CAL_ID        : (tuple(range(0, 100)), False),
+    FRAME_CAL_BAUD      : ((1200, 2400, 4800, 9600, 19200), False),
+    # by log time unit
+    FRAME_CAL_LOG_VALUE : {b'm': (tuple(range(1, 60)), False), b'h': (tuple(range(1, 25)), False)},
+}
+
+""" Plan U/D steps from a calibration frame to a new value, return (command, steps) or None
+    days: length of the month set on the probe, for day steps
+"""
+def plan_steps(frame, fields, new_value, days=31):
+    values, wrap = STEP_FIELDS[frame] if frame != FRAME_CAL_LOG_VALUE else STEP_FIELDS[frame][fields['unit']]
+    if frame == FRAME_CAL_DAY:
+        values = values[:days]
+    try:
+        current = values.index(int(fields['value']))
+        target = values.index(int(new_value))
+    except ValueError:
+        return None
+
+    up = target - current
+    if not wrap:
+        return ('U', up) if up >= 0 else ('D', -up)
+
+    # shortest way around
+    up %= len(values)
+    down = (len(values) - up) % len(values)
+    return ('U', up) if up <= down else ('D', down)
+
+
+""" Port as used in file names
+"""
+def port_tag(port):
+    return re.sub(r'\W', '_', str(port))
+
+# protocol operations are generators: they yield a command (str) and get its response
+# frame back, or yield one of these actions, performed by the transport
+ACTION_SLEEP  = 'sleep'   # (ACTION_SLEEP, seconds)
+ACTION_STORE  = 'store'   # (ACTION_STORE, download, frames) parse and store frames off the serial path
+ACTION_FINISH = 'finish'  # (ACTION_FINISH, download) wait for the stores, return True when records are durable
+
+
 #- ----------------------------------------------------------------------------
 #- classes
 #- ----------------------------------------------------------------------------
@@ -45,6 +281,26 @@ class Client:
     LF   = "\n"
     TAB  = "\t"
     SEMICOLON = ";"
+    CRLF_BYTES = b"\r\n"
+    CR_BYTES = b"\r"
+    SEMICOLON_BYTES = b";"
+
+    """ Serial timing (seconds), can be overridden by conf
+    """
+    TIMEOUT            = 2    # total time allowed for a response, first answer deadline of an unknown probe
+    TIMEOUT_MIN        = 0.3  # floor of the adaptive first answer deadline
+    INTER_BYTE_TIMEOUT = 0.5  # max silence once a response has started
+    READ_SLICE         = 0.05 # pyserial blocking read slice when no fd is available
+    PACE_MIN           = 0.01 # gap between wake up tries, from the probe latency
+    PACE_MAX           = 0.1
+
+    """ Calibration menu
+    """
+    MENU_STEPS = 15  # E + up to 14 M, last item is the baud rate
+    CONFIG_TTL = 60  # seconds a configuration snapshot is reused, can be overridden by conf
+    # probe_configure settings, in menu order
+    SETTINGS   = ('run', 'log_format', 'log_value', 'date_time', 'status', 'id', 'baud')
+    STEP_TRIES = 3   # U/D sequences sent for one value, each re-planned from the value read back
 
     """ Init
     """
@@ -55,6 +311,41 @@ class Client:
         self.conf = conf
         self.data_path = data_path
         self.ser = serial.Serial()
+        # file descriptor used to sleep while waiting for data
+        self.fd = None
+        # receive buffer, kept across commands, and framing scan position
+        self.rx_buffer = bytearray()
+        self.rx_scan = 0
+        # set on timeout, a late answer may still come: input dropped before the next command
+        self.rx_stale = False
+        # new id of a probe whose id is being changed, {id: new id}, its confirm answers with it
+        self.new_ids = {}
+        # response deadlines
+        self.timeout = float(conf.get('timeout', self.TIMEOUT))
+        self.inter_byte_timeout = float(conf.get('inter_byte_timeout', self.INTER_BYTE_TIMEOUT))
+        self.timeout_min = float(conf.get('timeout_min', self.TIMEOUT_MIN))
+        self.pace_min = float(conf.get('pace_min', self.PACE_MIN))
+        self.pace_max = float(conf.get('pace_max', self.PACE_MAX))
+        # response latency by probe id, kept across runs for this port,
+        # a probe never heard gets the whole timeout: it may be behind a slow radio hop
+        self.timers = {}
+        self.timers_file = os.path.join(data_path, "SondaTimers-"+port_tag(conf.get('port', ''))+".json")
+        self.__load_response_timers()
+        # configuration snapshots by probe id
+        self.config_ttl = float(conf.get('config_ttl', self.CONFIG_TTL))
+        self.snapshots = {}
+        # last stored record date time by probe id, probe clock
+        self.last_records = {}
+        # in process ingestion of validated records, probe_sink.RecordSink
+        self.sink = None
+        # download store stage, started by the first frames of a download
+        self.consumer = None
+        self.consumer_frames = None
+        # command counters and round trips, probe_metrics.Metrics
+        self.metrics = None
+        # last raw frames, dumped on errors, disabled with trace 0
+        trace_size = int(conf.get('trace', probe_trace.FrameTrace.SIZE))
+        self.trace = probe_trace.FrameTrace(data_path, conf.get('port', ''), trace_size) if trace_size else None
 
     def __del__(self):
         self.serial_close()
@@ -80,6 +371,17 @@ class Client:
                     bytesize = self.conf['bytesize'],
                     timeout  = 0 # non-blocking mode (return immediately on read)
                )
+                # sleep on the file descriptor when the platform provides one,
+                # otherwise let pyserial block for short read slices
+                self.fd = None
+                if os.name == 'posix':
+                    try:
+                        self.fd = self.ser.fileno()
+                    except Exception:
+                        self.fd = None
+                if self.fd is None:
+                    self.ser.timeout = self.READ_SLICE
+                logging.verbose("Serial wait on %s" % ('fd %s' % self.fd if self.fd is not None else 'read slices'))
                 #print self.ser.isOpen()
                 # confirm which port was really used
                 logging.verbose("Serial port %s" % (self.ser.portstr))
@@ -96,82 +398,316 @@ class Client:
             logging.warning("Serial port already opened")
             return True
 
+    """ Change baud rate of the opened port
+    """
+    def serial_set_baudrate(self, baudrate):
+        logging.debug("Function serial_set_baudrate() - baudrate: %s" % baudrate)
+        try:
+            self.ser.baudrate = int(baudrate)
+            # bytes received at the old speed are garbage
+            self.serial_reset_input()
+            return True
+
+        except Exception as e:
+            logging.critical("An exception was encountered in serial_set_baudrate(): %s" % str(e))
+            return False
+
     """ Close serial port and wipe out main object
     """
     def serial_close(self):
         logging.debug("Function serial_close()")
 
-        if self.ser.isOpen():
+        if self.ser and self.ser.isOpen():
+            self.save_response_timers()
             self.ser.close()
             self.ser = None
+            self.fd = None
             logging.verbose("Serial port closed.")
         else:
             logging.warning("Serial port not opened")
 
         return True
 
-    """ Read value from instrument
+    """ Wait for incoming data until deadline, without spinning
     """
-    def serial_get_response(self, command):
-        logging.verbose("Function serial_get_response()")
+    def __serial_wait(self, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+
+        if self.fd is not None:
+            # sleep on the file descriptor
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return None
+            return self.ser.read(self.ser.in_waiting or 1)
+
+        # blocking read of first byte (up to READ_SLICE), then whatever is waiting
+        buffer_data = self.ser.read(1)
+        if buffer_data and self.ser.in_waiting:
+            buffer_data += self.ser.read(self.ser.in_waiting)
+        return buffer_data
+
+    """ Extract next complete frame from receive buffer
+    """
+    def __serial_next_frame(self):
+        # look for CRLF only in data not scanned yet
+        pos = self.rx_buffer.find(self.CRLF_BYTES, self.rx_scan)
+        if pos < 0:
+            # keep last byte, it could be the CR of a split CRLF
+            self.rx_scan = max(0, len(self.rx_buffer) - 1)
+            return None
+
+        frame = bytes(self.rx_buffer[:pos])
+        # leftover bytes stay in the buffer for the next command
+        del self.rx_buffer[:pos + 2]
+        self.rx_scan = 0
+        return frame
+
+    """ Drop receive buffer and pending input
+    """
+    def serial_reset_input(self):
+        del self.rx_buffer[:]
+        self.rx_scan = 0
+        self.ser.flushInput()
+
+    """ Response timer of a probe id
+    """
+    def get_response_timer(self, id):
+        timer = self.timers.get(id)
+        if timer is None:
+            timer = ResponseTimer(self.timeout, self.timeout_min, self.timeout)
+            self.timers[id] = timer
+        return timer
+
+    """ Load response timers saved by a previous run
+    """
+    def __load_response_timers(self):
+        try:
+            if not os.path.exists(self.timers_file):
+                return
+            with open(self.timers_file, 'r') as the_file:
+                data = json.load(the_file)
+            for id, (srtt, rttvar) in data.items():
+                # probe ids only
+                if id.isdigit():
+                    self.get_response_timer(id).restore(srtt, rttvar)
+            logging.verbose("Response timers loaded %s" % data)
+
+        except Exception as e:
+            logging.warning("Invalid response timers %s: %s" % (self.timers_file, str(e)))
+
+    """ Save response timers atomically
+    """
+    def save_response_timers(self):
+        data = dict((id, [timer.srtt, timer.rttvar]) for id, timer in self.timers.items() if timer.srtt is not None)
+        if not data:
+            return
+        try:
+            tmp_name = self.timers_file + '.tmp'
+            with open(tmp_name, 'w') as the_file:
+                json.dump(data, the_file)
+            os.replace(tmp_name, self.timers_file)
+
+        except Exception as e:
+            logging.warning("Response timers not saved %s: %s" % (self.timers_file, str(e)))
+
+    """ Frame the answer to a command, shared by the transports
+        yields the bytes to send, then deadlines, and gets back the (first, last)
+        arrival time of the data added to rx_buffer meanwhile, None if none came
+        returns the response frame (bytes), empty on timeout
+    """
+    def serial_exchange(self, command):
+        data = (command + self.CR).encode()
+        # late answer to the command that timed out
+        if self.rx_stale:
+            self.serial_reset_input()
+            self.rx_stale = False
+        # round trip from the first command byte sent, the write is in it
+        start = time.time()
+        yield data
+        if self.trace is not None:
+            self.trace.tx(data)
+
+        logging.verbose("Reading data ...")
+        # first answer deadline from the probe latency, total deadline caps the frame,
+        # shortened to the inter byte timeout once data flows
+        timer = self.get_response_timer(command[:2])
+        timeout = start + self.timeout
+        answer_deadline = deadline = start + timer.timeout()
+        first = None
+        while True:
+            # analyse data, bytes left over by the previous command first
+            frame = self.__serial_next_frame()
+            if frame is not None and not self.__frame_answers(command, frame):
+                logging.warning("Frame of probe %s dropped, answer to %s expected" % (frame[8:10].decode('latin1'), command))
+                if self.trace is not None:
+                    self.trace.rx(frame)
+                # its arrival time is not the answer's, which may still come
+                first = None
+                deadline = answer_deadline
+                continue
+            if frame is not None:
+                logging.verbose("Response RX[%s]", frame)
+                if self.trace is not None:
+                    self.trace.rx(frame)
+                # latency of the probe itself, frames without id may be late answers of another
+                if first is not None and frame[8:10] == command[:2].encode() and frame.startswith(b'SA8340-'):
+                    timer.sample(first - start)
+                if self.metrics is not None:
+                    self.metrics.command(self.conf.get('port', ''), command, time.time() - start, frame)
+                return frame
+
+            arrival = yield deadline
+            # data check
+            if arrival is not None:
+                if first is None:
+                    first = arrival[0]
+                # partial response, next bytes must follow closely
+                deadline = min(timeout, arrival[1] + self.inter_byte_timeout)
+
+            # timeout check
+            elif time.time() >= deadline:
+                logging.warning("Serial timeout")
+                # more slack next time, the probe may be on a slower path
+                timer.expired()
+                if self.trace is not None:
+                    self.trace.partial(self.rx_buffer)
+                    self.trace.dump("timeout on %s" % command)
+                # resync, late bytes must not be taken as the next answer
+                self.serial_reset_input()
+                self.rx_stale = True
+                if self.metrics is not None:
+                    self.metrics.command(self.conf.get('port', ''), command, time.time() - start, b'', timed_out=True)
+                return b''
+
+    """ True if frame may answer command: SA8340- frames of the command probe id,
+        of any probe for 00, frames without id
+    """
+    def __frame_answers(self, command, frame):
+        if not frame.startswith(b'SA8340-'):
+            return True
+        frame_id = frame[8:10].decode('latin1')
+        id = command[:2]
+        return id == '00' or frame_id == id or frame_id == self.new_ids.get(id)
+
+    """ Send command and read response frame (bytes), empty on timeout
+    """
+    def serial_get_frame(self, command):
+        logging.verbose("Function serial_get_frame()")
         logging.verbose("Command %s", command)
         try:
             # check if port is opened
             if not self.ser.isOpen():
                 logging.warning("Serial port not opened")
-                return ''
+                return b''
 
-            # flush input buffer, discarding all its contents
-            logging.verbose("Flush serial input")
-            self.ser.flushInput()
+            exchange = self.serial_exchange(command)
+            data = next(exchange)
             # flush output buffer, aborting current output
             # and discard all that is in buffer
             logging.verbose("Flush serial output")
             self.ser.flushOutput()
 
             # write data
-            logging.verbose("Sending serial command TX[%s]" % str(command))
-            command = command + self.CR
-            if (sys.version_info > (3, 0)):
-                # Python 3 code in this block
-                self.ser.write(command.encode())
-            else:
-                # Python 2 code in this block
-                self.ser.write(command)
-                
+            logging.verbose("Sending serial command TX[%s]", command)
+            self.ser.write(data)
             self.ser.flush()
 
-            logging.verbose("Reading data ...")
-            # timeout 1 seconds from now
-            timeout = time.time() + 2
-            response = ''
-            regexpr = '(.*)'+self.CRLF
+            deadline = exchange.send(None)
             while True:
-                buffer_data = self.ser.read(1024)
-                # data check
+                buffer_data = self.__serial_wait(deadline)
+                arrival = None
                 if buffer_data:
-                    if (sys.version_info > (3, 0)):
-                        # Python 3 code in this block
-                        response = response + buffer_data.decode('latin1')
-                    else:
-                        # Python 2 code in this block
-                        response = response + buffer_data
+                    self.rx_buffer += buffer_data
+                    now = time.time()
+                    arrival = (now, now)
+                deadline = exchange.send(arrival)
 
-                    # analyse data
-                    matches = re.match(regexpr, response)
-                    if matches:
-                        response = matches.group(1)
-                        logging.verbose("Response RX[%s]" % str(response))
-                        return response
-
-                # timeout check
-                if time.time() > timeout:
-                    logging.warning("Serial timeout")
-                    return ''
+        except StopIteration as e:
+            return e.value
 
         except Exception as e:
-            logging.critical("An exception was encountered in serial_get_response(): %s" % str(e))
-            return ''
+            logging.critical("An exception was encountered in serial_get_frame(): %s" % str(e))
+            if self.trace is not None:
+                self.trace.dump("exception in serial_get_frame(): %s" % str(e), force=True)
+            return b''
+
+    """ Read value from instrument, as text
+    """
+    def serial_get_response(self, command):
+        return self.serial_get_frame(command).decode('latin1')
+
+
+
+
+    """ PROTOCOL DRIVER
+    """
+
+    """ Run a protocol operation with blocking serial IO, return its result
+    """
+    def run(self, operation):
+        result = None
+        error = None
+        while True:
+            try:
+                if error is not None:
+                    action = operation.throw(error)
+                else:
+                    action = operation.send(result)
+            except StopIteration as e:
+                return e.value
+
+            result = None
+            error = None
+            try:
+                result = self.__perform(action)
+            except Exception as e:
+                # raised where the operation asked for it
+                error = e
+
+    """ Perform one action of a protocol operation
+    """
+    def __perform(self, action):
+        # command, answered with the response frame
+        if isinstance(action, str):
+            return self.serial_get_frame(action)
+
+        kind = action[0]
+        if kind == ACTION_SLEEP:
+            time.sleep(action[1])
+            return None
+
+        if kind == ACTION_STORE:
+            # consumer stage: parse and write frames off the serial path
+            download, frames = action[1:]
+            if self.consumer is None:
+                self.consumer_frames = queue.Queue()
+                self.consumer = threading.Thread(target=self.__consumer, args=(self.consumer_frames,))
+                self.consumer.daemon = True
+                self.consumer.start()
+            self.consumer_frames.put((download, frames))
+            return not download.failed
+
+        if kind == ACTION_FINISH:
+            # drain consumer
+            if self.consumer is not None:
+                self.consumer_frames.put(None)
+                self.consumer.join()
+                self.consumer = None
+            return action[1].finish()
+
+        raise ValueError("unknown protocol action %s" % kind)
+
+    """ Consumer stage, store frames batches until None
+    """
+    def __consumer(self, frames):
+        while True:
+            batch = frames.get()
+            if batch is None:
+                return
+            download, batch = batch
+            download.store(batch)
 
 
 
@@ -182,17 +718,26 @@ class Client:
     """ Wake up probe
     """
     def probe_wakeup(self, id):
+        return self.run(self.protocol_wakeup(id))
+
+    """ Switch off probe
+    """
+    def probe_switch_off(self):
+        return self.run(self.protocol_switch_off())
+
+    """ Wake up probe, protocol operation
+    """
+    def protocol_wakeup(self, id):
         logging.debug("Function probe_wakeup()")
         try:
             # get group values
             for _ in range(3):
-                response = self.serial_get_response(id+'A')
-                if response != '':
+                response = yield id+'A'
+                if response:
                     logging.verbose("Function probe_wakeup() - Exit")
                     return True
-                    break
 
-                time.sleep(0.1)
+                yield (ACTION_SLEEP, self.get_response_timer(id).pacing(self.pace_min, self.pace_max))
 
             logging.warning("Probe does not respond")
             return False
@@ -201,15 +746,14 @@ class Client:
             logging.critical("An exception was encountered in probe_wakeup(): %s" % str(e))
             return False
 
-
-    """ Switch off probe
+    """ Switch off probe, protocol operation
     """
-    def probe_switch_off(self):
+    def protocol_switch_off(self):
         logging.debug("Function probe_switch_off()")
         try:
-            response = self.serial_get_response('00O')
+            response = yield '00O'
             logging.debug("-> response %s" % response)
-            response = self.serial_get_response('00I')
+            response = yield '00I'
             logging.verbose("-->>-->> response %s" % response)
 
         except Exception as e:
@@ -221,676 +765,501 @@ class Client:
     """ PROBE COMMON FUNCTIONS
     """
 
-    """ Get bcc code
+    """ Step calibration value to new_value from its current frame, then confirm
+        return (value set or False, last response)
     """
-    def __get_bcc(self, record):
-        logging.debug("Function __get_bcc() - record: %s" % record)
+    def __set_probe_value(self, id, response, frame, new_value, days=31):
+        logging.debug("Function __set_probe_value() - new_value: %s, frame: %s" % (new_value, frame))
         try:
-            bcc = 0
-            for char in record:
-                bcc = bcc ^ ord(char)
-
-            logging.verbose("Bcc: %s" % bcc)
-            # split into 2 nibbles
-            high, low = bcc >> 4, bcc & 0x0F
-            logging.verbose("High: %s, low: %s" % (high, low))
-            #print(hex(bcc), hex(high), hex(low))
-            #print('{:X}'.format(high), '{:X}'.format(low))
-            # convert to hexadecimal, withot \x
-            bcc = '{:X}'.format(high) + '{:X}'.format(low)
-            logging.debug("Bcc: %s" % bcc)
-            return bcc
-
-        except Exception as e:
-            logging.critical("An exception was encountered in __get_bcc(): %s" % str(e))
-            return None
-
+            # the value read back after the last sequence is checked too
+            for attempt in range(self.STEP_TRIES + 1):
+                kind, fields = parse_frame(response)
+                if kind != frame:
+                    logging.warning("Unexpected calibration frame %s" % response)
+                    return False, response
+
+                plan = plan_steps(frame, fields, new_value, days)
+                if plan is None:
+                    logging.warning("Value %s out of range" % new_value)
+                    return False, response
+
+                cmd, steps = plan
+                if steps == 0:
+                    logging.info("Value set to %s" % fields['value'].decode())
+                    # confirm and store new value setting
+                    response = yield id+'I'
+                    logging.verbose("Probe response %s" % response)
+                    return fields['value'], response
+
+                if attempt == self.STEP_TRIES:
+                    logging.warning("Value %s not reached, probe at %s" % (new_value, fields['value'].decode()))
+                    break
 
-    """ Set new value up or down
-    """
-    def __set_probe_value_up_down(self, id, new_value, reg, cmd):
-        logging.debug("Function __set_probe_value_up_down() - new_value: %s, reg: %s, cmd: %s" % (new_value, reg, cmd))
-        try:
-            i = 0
-            for i in range(10): # max tries
-                # send up or down command
-                response = self.serial_get_response(id+cmd)
+                # whole sequence, value checked on the last answer only
+                logging.debug("Stepping %s x %d from %s" % (cmd, steps, fields['value'].decode()))
+                for _ in range(steps):
+                    response = yield id+cmd
                 logging.verbose("Probe response %s" % response)
-                # check for match
-                matches = re.match(reg, response)
-                if matches:
-                    current_value = matches.group(1)
-                    logging.verbose("Probe value %s" % current_value)
-                    # check for correct value - int
-                    if int(current_value) == int(new_value):
-                        logging.info("Value set to %s" % str(current_value))
-                        # confirm and store new value setting
-                        response = self.serial_get_response(id+'I')
-                        logging.verbose("Probe response %s" % response)
-                        return current_value
-                        break;
 
-            return False
+            return False, response
 
         except Exception as e:
-            logging.critical("An exception was encountered in __set_probe_value_up_down(): %s" % str(e))
-            return False
+            logging.critical("An exception was encountered in __set_probe_value(): %s" % str(e))
+            return False, response
 
 
 
     """ PROBE GETTERS
     """
 
-    """ Get probe id
+    """ Get configuration snapshot, one menu walk reused for config_ttl seconds
     """
-    def get_probe_id(self, id):
-        logging.debug("Function get_probe_date()")
+    def get_probe_snapshot(self, id, refresh=False):
+        return self.run(self.protocol_snapshot(id, refresh))
+
+    """ Get configuration snapshot, protocol operation
+    """
+    def protocol_snapshot(self, id, refresh=False):
+        logging.debug("Function get_probe_snapshot() - id: %s, refresh: %s" % (id, refresh))
+        snapshot = self.snapshots.get(id)
+        if snapshot is not None and not refresh and snapshot.age() < self.config_ttl:
+            logging.verbose("Snapshot cached %.1fs ago" % snapshot.age())
+            return snapshot
+
         try:
-            # find item
-            for i in range(15):
+            snapshot = ConfigSnapshot()
+            for i in range(self.MENU_STEPS):
                 if i==0:
                     # enter calibration
-                    response = self.serial_get_response(id+'E')
+                    response = yield id+'E'
                 else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("%02d response %s" % (i+1, response))
-                reg = 'SA8340.+SA8340\sR\d\.\d\d\s+ID:\s(\d\d).+'
-                matches = re.match(reg, response)
-                if matches:
-                    return matches.group(1)
+                    response = yield id+'M'
 
-                    # exit loop
+                logging.debug("-> %02d response %s" % (i+1, response))
+                kind, fields = parse_frame(response)
+                snapshot.add(response, kind, fields)
+                # baud rate is the last item, next one wraps around
+                if kind == FRAME_BAUD:
                     break
 
-            return None
+            # cache only a full walk, a timeout may have skipped items
+            if snapshot.baud is not None:
+                self.snapshots[id] = snapshot
+            else:
+                self.snapshots.pop(id, None)
+            return snapshot
 
         except Exception as e:
-            logging.critical("An exception was encountered in get_probe_id(): %s" % str(e))
+            logging.critical("An exception was encountered in get_probe_snapshot(): %s" % str(e))
             return None
 
+    """ Forget configuration snapshot, probe settings changed
+    """
+    def invalidate_snapshot(self, id):
+        self.snapshots.pop(id, None)
+
+    """ Get probe id
+    """
+    def get_probe_id(self, id):
+        logging.debug("Function get_probe_id()")
+        snapshot = self.get_probe_snapshot(id)
+        if snapshot is None:
+            return None
+        return snapshot.probe_id
+
     """ Read main configuration
     """
     def get_probe_configuration(self, id):
         logging.debug("Function get_probe_configuration()")
-        try:
-            # config
-            config = self.CRLF
-            # find items
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("%02d response %s" % (i+1, response))
-                config = config + response + self.CRLF
-
-            return config
-
-        except Exception as e:
-            logging.critical("An exception was encountered in get_probe_configuration(): %s" % str(e))
+        snapshot = self.get_probe_snapshot(id)
+        if snapshot is None:
             return None
+        return self.CRLF + ''.join(line + self.CRLF for line in snapshot.lines)
 
     """ Get probe baud rate
     """
     def get_probe_baud_rate(self, id):
         logging.debug("Function get_probe_baud_rate()")
-        try:
-            # find item
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("-> %02d response %s" % (i+1, response))
-
-                # SA8340- 00 SA8340 R2.63    ID: 00          51
-                reg = 'SA8340.+TRANSMISSION\s+BAUD\sRATE.+(1200|2400|4800|9600|19200)..'
-                matches = re.match(reg, response)
-                if matches:
-                    return matches.group(1)
-
-                    # exit loop
-                    break
-
-        except Exception as e:
-            logging.critical("An exception was encountered in get_probe_baud_rate(): %s" % str(e))
+        snapshot = self.get_probe_snapshot(id)
+        if snapshot is None or snapshot.baud is None:
             return None
+        return str(snapshot.baud)
 
     """ Get probe date
     """
     def get_probe_date(self, id):
         logging.debug("Function get_probe_date()")
-        try:
-            # find item
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
+        snapshot = self.get_probe_snapshot(id)
+        if snapshot is None or snapshot.time is None:
+            return None
+        # probe clock kept running since the snapshot
+        return snapshot.probe_time().strftime('%d/%m/%y %H:%M:%S')
 
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # SA8340- 00 TIME  22/03/17        12:07:58
-                reg = 'SA8340.+TIME\s+(\d\d\/\d\d\/\d\d)\s+(\d\d:\d\d:\d\d).+'
-                matches = re.match(reg, response)
-                if matches:
-                    return matches.group(1)+' '+matches.group(2)
 
-                    # exit loop
-                    break
 
-        except Exception as e:
-            logging.critical("An exception was encountered in get_probe_date(): %s" % str(e))
-            return None
 
 
+    """ PROBE SETTERS
+    """
 
+    """ Apply running state on LOG ON TIME item
+    """
+    def __apply_running(self, id, fields, status):
+        cur_status = fields['state'].decode()
+        logging.info("Status %s" % cur_status)
 
+        if cur_status == status:
+            logging.info("Running OK")
+            return True
 
-    """ PROBE SETTERS
+        if status == 'STOP':
+            logging.info("Status turning OFF")
+            response = yield id+'D'
+        else:
+            logging.info("Status turning ON")
+            response = yield id+'U'
+        logging.debug("-->> response %s" % response)
+        response = yield id+'I'
+        logging.debug("-->> response %s" % response)
+        return True
+
+    """ Apply log time format and value on LOG ON TIME item, one calibration sequence
+    """
+    def __apply_log_time(self, id, fields, format=None, value=None):
+        results = {}
+        cur_format = 'Hours' if fields['unit'] == b'h' else 'Minutes'
+        cur_value = int(fields['value'])
+        if format in (None, cur_format) and value in (None, cur_value):
+            logging.info("Log format and value are correct")
+            if format is not None:
+                results['log_format'] = True
+            if value is not None:
+                results['log_value'] = True
+            return results
+
+        # SA8340- 00 CAL LOG:        ON TIME         34
+        logging.debug("Start calibration sequense")
+        response = yield id+'C'
+        logging.debug("-->> response %s" % response)
+        if parse_frame(response)[0] != FRAME_CAL_LOG_ON:
+            return dict((key, False) for key, wanted in (('log_format', format), ('log_value', value)) if wanted is not None)
+
+        # SA8340- 00 CAL LOG: T.INT   Minutes        54
+        # SA8340- 00 CAL LOG: T.INT   Hours          5A
+        response = yield id+'I'
+        logging.debug("-->> response %s" % response)
+        kind, fields = parse_frame(response)
+        if format is not None:
+            if kind != FRAME_CAL_LOG_FORMAT:
+                results['log_format'] = False
+            elif fields['format'].decode() == format:
+                logging.info("Log format is correct - %s" % format)
+                results['log_format'] = True
+            else:
+                logging.info("Setting %s" % format.upper())
+                response = yield id+('U' if format == 'Hours' else 'D')
+                logging.debug("-->> response %s" % response)
+                kind, fields = parse_frame(response)
+                results['log_format'] = (kind == FRAME_CAL_LOG_FORMAT and fields['format'].decode() == format)
+
+        # SA8340- 00 CAL LOG: T.INT   59m            68
+        response = yield id+'I'
+        logging.debug("-->> response %s" % response)
+        if value is None:
+            # confirm and store
+            response = yield id+'I'
+            logging.debug("-->> response %s" % response)
+            return results
+
+        res, response = yield from self.__set_probe_value(id, response, FRAME_CAL_LOG_VALUE, value)
+        results['log_value'] = (res is not False and int(res) == int(value))
+        return results
+
+    """ Apply date and time on TIME item, <YYYY-MM-DD> <HH:MM>
     """
+    def __apply_date_time(self, id, fields, date, time):
+        reg = '\d\d(\d\d)-(\d\d)-(\d\d)'
+        matches = re.match(reg, date)
+        if not matches:
+            logging.warning("wrong date")
+            return False
+        year = matches.group(1)
+        month = matches.group(2)
+        day = matches.group(3)
+
+        reg = '(\d\d):(\d\d)'
+        matches = re.match(reg, time)
+        if not matches:
+            logging.warning("wrong time")
+            return False
+        hour = matches.group(1)
+        minute = matches.group(2)
+        logging.debug("Date %s %s %s %s %s" % (year, month, day, hour, minute))
 
-    """ Set probe id
+        # SA8340- 00 TIME  01/09/17        15:58:29  29
+        fields = decode_fields(fields)
+        logging.debug("Probe time %s/%s/%s %s:%s" % (fields['day'], fields['month'], fields['year'], fields['hour'], fields['minute']))
+
+        if int(day) > calendar.monthrange(2000 + int(year), int(month))[1]:
+            logging.warning("wrong date")
+            return False
+
+        # the day comes first and the probe refuses days missing in its month:
+        # days past 28 are set by a second sequence, once month and year are in place
+        days = [min(int(day), 28)]
+        if int(day) > 28:
+            days.append(int(day))
+        month_days = calendar.monthrange(2000 + int(fields['year']), int(fields['month']))[1]
+        for new_day in days:
+            # need to be changed
+            logging.debug("Start calibration sequense")
+            response = yield id+'C'
+            logging.debug("-->> response %s" % response)
+
+            # calibration steps in probe order
+            steps = [
+                ('day', new_day, FRAME_CAL_DAY),
+                ('month', month, FRAME_CAL_MONTH),
+                ('year', year, FRAME_CAL_YEAR),
+                ('hour', hour, FRAME_CAL_HOUR),
+                ('minute', minute, FRAME_CAL_MINUTE),
+            ]
+            for name, new_value, frame in steps:
+                logging.debug("Set %s" % name)
+                # confirming a field answers with the next one
+                res, response = yield from self.__set_probe_value(id, response, frame, new_value, month_days)
+                if res is False:
+                    # still in calibration, next steps would go to the wrong field
+                    return False
+
+            # month and year of the probe from now on
+            month_days = calendar.monthrange(2000 + int(year), int(month))[1]
+
+        return True
+
+    """ Apply power status on POWER item
     """
-    def set_probe_id(self, id, newid):
-        logging.debug("Function set_probe_id() - id: %s, new id: %s" % (id, newid))
-        try:
-            # find item
-            logging.verbose('Looping in range')
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
+    def __apply_status(self, id, fields, status):
+        # SA8340- 00     POWER ON                    4E
+        cur_status = fields['state'].decode()
+        logging.info("Status %s" % cur_status)
 
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # SA8340- 00 SA8340 R2.63    ID: 00          51
-                reg = 'SA8340.+SA8340\sR\d\.\d\d\s+ID:\s(\d\d).+'
-                matches = re.match(reg, response)
-                if matches:
-                    # check if we need to increase or decrease the value
-                    cur_id = int(matches.group(1))
-                    if cur_id == newid:
-                        logging.debug("Id is correct")
-                        return True
-
-                    # need to be changed
-                    logging.debug("Start calibration sequense")
-                    response = self.serial_get_response(id+'C')
-                    logging.debug("-->> response %s" % response)
-                    # reg expression
-                    reg = 'SA8340.+SA8340\sR\d\.\d\d\s+CAL ID:\s(\d\d).+'
-                    if cur_id < newid:
-                        logging.debug("Id must be incremented")
-                        res = self.__set_probe_value_up_down(id, newid, reg, 'U')
-                    else:
-                        logging.debug("Id must be decremented")
-                        res = self.__set_probe_value_up_down(id, newid, reg, 'D')
+        if cur_status == status:
+            logging.info("Status OK")
+            return True
 
-                    # exit loop
-                    return (res == newid)
+        if cur_status == 'ON':
+            logging.info("Status turning OFF")
+            response = yield id+'D'
+            logging.debug("-->> response %s" % response)
+        else:
+            logging.info("Status turning ON")
+            response = yield id+'U'
+            logging.debug("-->> response %s" % response)
 
-        except Exception as e:
-            logging.critical("An exception was encountered in set_probe_id(): %s" % str(e))
-            return None
+        response = yield id+'I'
+        # SA8340- 00     POWER OFF       **WAIT**    2B
+        logging.debug("-->> response %s" % response)
+        return True
 
-    """ Set probe time
+    """ Apply probe id on ID item
     """
-    def set_probe_date_time(self, id, date, time):
-        logging.debug("Function set_probe_date_time() - id: %s, new value: %s %s" % (id, date, time))
+    def __apply_id(self, id, fields, newid):
+        # SA8340- 00 SA8340 R2.63    ID: 00          51
+        cur_id = int(fields['probe_id'])
+        if cur_id == newid:
+            logging.debug("Id is correct")
+            return True
+
+        # need to be changed
+        logging.debug("Start calibration sequense")
+        response = yield id+'C'
+        logging.debug("-->> response %s" % response)
+        # confirm is answered with the new id
+        self.new_ids[id] = str(newid).zfill(2)
         try:
-            reg = '\d\d(\d\d)-(\d\d)-(\d\d)'
-            matches = re.match(reg, date)
-            if not matches:
-                logging.warning("wrong date")
-                return False
-            year = matches.group(1)
-            month = matches.group(2)
-            day = matches.group(3)
-
-            reg = '(\d\d):(\d\d)'
-            matches = re.match(reg, time)
-            if not matches:
-                logging.warning("wrong time")
-                return False
-            hour = matches.group(1)
-            minute = matches.group(2)
-            logging.debug("Date %s %s %s %s %s" % (year, month, day, hour, minute))
+            res, response = yield from self.__set_probe_value(id, response, FRAME_CAL_ID, newid)
+        finally:
+            self.new_ids.pop(id, None)
+
+        return (res is not False and int(res) == int(newid))
+
+    """ Apply serial baud rate on BAUD item
+    """
+    def __apply_baud(self, id, fields, baud):
+        # SA8340- 00 TRANSMISSION    BAUD RATE:  24002A
+        cur_baud = fields['baud']
+        logging.info("Baud rate %s" % cur_baud)
+
+        if int(cur_baud) == int(baud):
+            logging.info("Baud rate OK")
+            return True
+
+        # need to be changed
+        logging.debug("Start calibration sequense")
+        response = yield id+'C'
+        logging.debug("-->> response %s" % response)
+        res, response = yield from self.__set_probe_value(id, response, FRAME_CAL_BAUD, baud)
+
+        return (res is not False and int(res) == int(baud))
 
-            # find item
-            for i in range(15):
+    """ Apply several settings in one menu walk, return {setting: result}
+        settings: run (START|STOP), log_format (Hours|Minutes), log_value,
+        date_time (<YYYY-MM-DD>, <HH:MM>), status (ON|OFF), id, baud
+    """
+    def probe_configure(self, id, settings):
+        return self.run(self.protocol_configure(id, settings))
+
+    """ Apply several settings in one menu walk, protocol operation
+    """
+    def protocol_configure(self, id, settings):
+        logging.debug("Function probe_configure() - id: %s, settings: %s" % (id, settings))
+        results = {}
+        for key in settings:
+            if key not in self.SETTINGS:
+                logging.warning("Unknown setting %s" % key)
+                results[key] = False
+        pending = set(settings) - set(results)
+        first_id = id
+        try:
+            # settings are applied in menu order, while walking
+            for i in range(self.MENU_STEPS):
+                if not pending:
+                    break
                 if i==0:
                     # enter calibration
-                    response = self.serial_get_response(id+'E')
+                    response = yield id+'E'
                 else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.verbose("-> %02d response %s" % (i+1, response))
-                # SA8340- 00 SA8340 R2.63    ID: 00          51
-                reg = 'SA8340.+TIME\s+(\d\d)\/(\d\d)\/(\d\d)\s+(\d\d):(\d\d):(\d\d).+'
-                # Full match  0-45    `SA8340- 00 TIME  01/09/17        15:58:29  29`
-                # Group 1.    17-19   `01`
-                # Group 2.    20-22   `09`
-                # Group 3.    23-25   `17`
-                # Group 4.    33-35   `15`
-                # Group 5.    36-38   `58`
-                # Group 6.    39-41   `29`
-                matches = re.match(reg, response)
-                if matches:
-                    logging.debug("Probe time %s" % response)
-                    # check if we need to increase or decrease the value
-                    cur_day = matches.group(1)
-                    if cur_day == day:
-                        logging.debug("Day is correct")
-
-                    cur_month = matches.group(2)
-                    if cur_month == month:
-                        logging.debug("Month is correct")
-
-                    cur_year = matches.group(3)
-                    if cur_year == year:
-                        logging.debug("Year is correct")
-
-                    cur_hour = matches.group(4)
-                    if cur_hour == hour:
-                        logging.debug("Hour is correct")
-
-                    cur_minute = matches.group(5)
-                    if cur_minute == minute:
-                        logging.debug("Minute is correct")
-
-                    # need to be changed
-                    logging.debug("Start calibration sequense")
-                    response = self.serial_get_response(id+'C')
-                    logging.debug("-->> response %s" % response)
-
-                    # set day
-                    logging.debug("Set day")
-                    reg = 'SA8340.+CAL\sTIME\s+DAY\s+(\d\d).+'
-                    if cur_day < day:
-                        logging.debug("Day must be incremented")
-                        res = self.__set_probe_value_up_down(id, day, reg, 'U')
-                    elif cur_day > day:
-                        logging.debug("Day must be decremented")
-                        res = self.__set_probe_value_up_down(id, day, reg, 'D')
-                    else:
-                        logging.debug("Next bit of date")
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
-
-                    # set month
-                    logging.debug("Set month")
-                    reg = 'SA8340.+CAL\sTIME\s+MON\.\s+(\d\d).+'
-                    if cur_month < month:
-                        logging.debug("Day must be incremented")
-                        res = self.__set_probe_value_up_down(id, month, reg, 'U')
-                    elif cur_month > month:
-                        logging.debug("Day must be decremented")
-                        res = self.__set_probe_value_up_down(id, month, reg, 'D')
-                    else:
-                        logging.debug("Next bit of date")
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
-
-                    # set year
-                    logging.debug("Set year")
-                    reg = 'SA8340.+CAL\sTIME\s+YEAR\s+(\d\d).+'
-                    if cur_year < year:
-                        logging.debug("Day must be incremented")
-                        res = self.__set_probe_value_up_down(id, year, reg, 'U')
-                    elif cur_year > year:
-                        logging.debug("Day must be decremented")
-                        res = self.__set_probe_value_up_down(id, year, reg, 'D')
-                    else:
-                        logging.debug("Next bit of date")
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
-
-                    # set hour
-                    logging.debug("Set hour")
-                    reg = 'SA8340.+CAL\sTIME\s+HOUR\s+(\d\d).+'
-                    if cur_hour < hour:
-                        logging.debug("Hour must be incremented")
-                        res = self.__set_probe_value_up_down(id, hour, reg, 'U')
-                    elif cur_hour > hour:
-                        logging.debug("Hour must be decremented")
-                        res = self.__set_probe_value_up_down(id, hour, reg, 'D')
-                    else:
-                        logging.debug("Next bit of date")
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
-
-                    # set minute
-                    logging.debug("Set minute")
-                    reg = 'SA8340.+CAL\sTIME\s+MIN\.\s+(\d\d).+'
-                    if cur_minute < minute:
-                        logging.debug("Minute must be incremented")
-                        res = self.__set_probe_value_up_down(id, minute, reg, 'U')
-                    elif cur_minute > minute:
-                        logging.debug("Minute must be decremented")
-                        res = self.__set_probe_value_up_down(id, minute, reg, 'D')
-                    else:
-                        logging.debug("End setting date time")
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
+                    response = yield id+'M'
 
-                    # exit loop
-                    return True
+                logging.debug("-> %02d response %s" % (i+1, response))
+                kind, fields = parse_frame(response)
+                if kind == FRAME_LOG_ON_TIME:
+                    if 'run' in pending:
+                        results['run'] = yield from self.__apply_running(id, fields, settings['run'])
+                    if 'log_format' in pending or 'log_value' in pending:
+                        results.update((yield from self.__apply_log_time(id, fields, settings.get('log_format'), settings.get('log_value'))))
+
+                elif kind == FRAME_TIME and 'date_time' in pending:
+                    results['date_time'] = yield from self.__apply_date_time(id, fields, *settings['date_time'])
+                    # record times of a resumed download no longer follow the stored ones
+                    Checkpoint(self.data_path, id, self.conf.get('port', '')).clear()
+
+                elif kind == FRAME_POWER and 'status' in pending:
+                    results['status'] = yield from self.__apply_status(id, fields, settings['status'])
+                    pending.discard('status')
+                    if settings['status'] == 'OFF' and pending:
+                        logging.warning("Probe switched off, settings not applied: %s" % ', '.join(sorted(pending)))
+                        break
+
+                elif kind == FRAME_ID and 'id' in pending:
+                    results['id'] = yield from self.__apply_id(id, fields, settings['id'])
+                    if results['id']:
+                        # probe answers to the new id from now on
+                        id = str(settings['id']).zfill(2)
+
+                elif kind == FRAME_BAUD and 'baud' in pending:
+                    results['baud'] = yield from self.__apply_baud(id, fields, settings['baud'])
+
+                applied = pending & set(results)
+                pending -= applied
+                if not all(results[key] for key in applied):
+                    # probe may be left inside a calibration sequence, menu position unknown
+                    logging.warning("Setting %s failed, walk stopped" % ', '.join(sorted(applied)))
                     break
+                # baud rate is the last item, next one wraps around
+                if kind == FRAME_BAUD:
+                    break
+
+            for key in pending:
+                logging.warning("Setting %s not applied" % key)
+                results[key] = False
+            return results
 
         except Exception as e:
-            logging.critical("An exception was encountered in set_probe_id(): %s" % str(e))
+            logging.critical("An exception was encountered in probe_configure(): %s" % str(e))
+            return None
+
+        finally:
+            self.invalidate_snapshot(first_id)
+            self.invalidate_snapshot(id)
+
+    """ Apply one setting, return its result
+    """
+    def __configure_one(self, id, key, value):
+        results = self.probe_configure(id, {key: value})
+        if results is None:
             return None
+        return results.get(key)
+
+    """ Set probe id
+    """
+    def set_probe_id(self, id, newid):
+        logging.debug("Function set_probe_id() - id: %s, new id: %s" % (id, newid))
+        return self.__configure_one(id, 'id', newid)
+
+    """ Set probe time
+    """
+    def set_probe_date_time(self, id, date, time):
+        logging.debug("Function set_probe_date_time() - id: %s, new value: %s %s" % (id, date, time))
+        return self.__configure_one(id, 'date_time', (date, time))
 
     """ Set probe log time format Minutes|Hours
     """
     def set_probe_log_time_format(self, id, format):
         logging.debug("Function set_probe_log_time_format()")
-        try:
-            # find item
-            for i in range(15):
-                if i == 0:
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # analyse data
-                # SA8340- 00 LOG ON TIME 59m START           61
-                # SA8340- 00 LOG ON TIME 24h START           6E
-                # SA8340- 00 LOG ON TIME 24h STOP   17h 14/0755
-                reg1 = 'SA8340.+LOG\sON\sTIME.+(START|STOP).+'
-                if re.match(reg1, response):
-                    logging.debug("Start calibration sequense")
-                    response = self.serial_get_response(id+'C')
-                    logging.debug("->-> response %s" % (response))
-                    if re.match('SA8340.+CAL\sLOG:\s+ON\sTIME.+', response):
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("->->-> response %s" % (response))
-                        # SA8340- 00 CAL LOG: T.INT   Minutes        54
-                        # SA8340- 00 CAL LOG: T.INT   Hours          5A
-                        reg2 = 'SA8340.+CAL\s+LOG:\s+T\.INT\s+(Minutes|Hours).+'
-                        matches = re.match(reg2, response)
-                        if matches:
-                            # check if we need to increase or decrease the value
-                            if matches.group(1) == 'Hours': # 'Hours' | 'Minutes'
-                                if format == 'Hours':
-                                    logging.info("Log format is correct - Hours")
-                                    return True
-
-                                logging.info("Setting MINUTES")
-                                response = self.serial_get_response(id+'D')
-                                logging.debug("->->->-> response %s" % (response))
-                                # SA8340- 00 CAL LOG: T.INT   Hours          5A
-                                response = self.serial_get_response(id+'I')
-                                return True
-
-                            else:
-                                if format == 'Minutes':
-                                    logging.info("Log format is correct - Minutes")
-                                    return True
-
-                                logging.info("Setting HOURS")
-                                response = self.serial_get_response(id+'U')
-                                logging.debug("->->->-> response %s" % (response))
-                                # SA8340- 00 CAL LOG: T.INT   Hours          5A
-                                response = self.serial_get_response(id+'I')
-                                return True
-
-                            # exit loop
-                            break
-
-        except Exception as e:
-            logging.critical("An exception was encountered in set_probe_log_time_format(): %s" % str(e))
-            return None
+        return self.__configure_one(id, 'log_format', format)
 
     """ Set probe log time
     """
     def set_probe_log_time(self, id, value):
         logging.debug("Function set_probe_log_time() - value: %s" % str(value))
-        try:
-            # find item
-            for i in range(15):
-                if i == 0:
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # analyse data
-                # SA8340- 00 LOG ON TIME 59m START           61
-                reg = 'SA8340.+LOG\sON\sTIME\s+(\d+)(m|h)\s(START|STOP).+'
-                matches = re.match(reg, response)
-                if matches:
-                    # check if we need to increase or decrease the value
-                    cur_value = int(matches.group(1))
-                    if cur_value == value:
-                        logging.info("Minutes|Hours are correct")
-                        return True
-
-                    # 00A
-                    # SA8340- 00 5.1 23/03/17 14:05:37   0.007m      23.56øC     0.000mS    11.067pH   22/03/17DB
-                    # 00E
-                    # SA8340- 00 LOG ON TIME 59m START           61
-                    # 00C
-                    # SA8340- 00 CAL LOG:        ON TIME         34
-                    # 00I
-                    # SA8340- 00 CAL LOG: T.INT   Minutes        54
-                    # 00I
-                    # SA8340- 00 CAL LOG: T.INT   59m            68
-                    # 00D
-                    # SA8340- 00 CAL LOG: T.INT   59m            68
-                    # 00D
-                    # SA8340- 00 CAL LOG: T.INT   58m            69
-
-                    # need to be changed
-                    logging.debug("Start calibration sequense")
-                    response = self.serial_get_response(id+'C')
-                    # SA8340- 00 CAL LOG:        ON TIME         34
-                    logging.debug("-->> response %s" % response)
-                    if re.match('SA8340.+CAL\sLOG:\s+ON\sTIME.+', response):
-
-                        response = self.serial_get_response(id+'I')
-                        # SA8340- 00 CAL LOG: T.INT   Minutes        54
-                        logging.debug("-->> response %s" % response)
-                        if re.match('SA8340.+CAL\sLOG:\s+T.INT\s+(Minutes|Hours).+', response):
-
-                            response = self.serial_get_response(id+'I')
-                            # SA8340- 00 CAL LOG: T.INT   59m            68
-                            logging.debug("-->> response %s" % response)
-                            reg = 'SA8340.+CAL\sLOG:\s+T.INT\s+(\d+)(m|h).+'
-                            if re.match(reg, response):
-                                if int(cur_value) < int(value):
-                                    logging.debug("Minutes|Hours must be incremented")
-                                    res = self.__set_probe_value_up_down(id, value, reg, 'U')
-                                else:
-                                    logging.debug("Minutes|Hours must be decremented")
-                                    res = self.__set_probe_value_up_down(id, value, reg, 'D')
-
-                                # exit loop
-                                return (int(res) == int(value))
-
-        except Exception as e:
-            logging.critical("An exception was encountered in set_probe_log_time(): %s" % str(e))
-            return None
+        return self.__configure_one(id, 'log_value', value)
 
     """ Set probe serial baud rate
     """
     def set_probe_baud_rate(self, id, baud):
         logging.debug("Function set_probe_baud_rate() - baud: %s" % baud)
-        try:
-            # find item
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # analyse data
-                # SA8340- 00 TRANSMISSION    BAUD RATE:  24002A
-                reg = 'SA8340.+TRANSMISSION\s+BAUD\sRATE.+(1200|2400|4800|9600|19200)..'
-                matches = re.match(reg, response)
-                if matches:
-                    # check if we need to increase or decrease the value
-                    cur_baud = matches.group(1)
-                    logging.info("Baud rate %s" % cur_baud)
-
-                    if int(cur_baud) == int(baud):
-                        logging.info("Baud rate OK")
-                        return True
-
-                    # need to be changed
-                    logging.debug("Start calibration sequense")
-                    response = self.serial_get_response(id+'C')
-                    logging.debug("-->> response %s" % response)
-                    reg = 'SA8340.+CAL\sTRANSMISSIONBAUD RATE:\s+(\d+)..'
-                    if int(cur_baud) < int(baud):
-                        logging.debug("Baud must be incremented")
-                        res = self.__set_probe_value_up_down(id, baud, reg, 'U')
-                    else:
-                        logging.debug("Baud must be decremented")
-                        res = self.__set_probe_value_up_down(id, baud, reg, 'D')
-
-                    # exit loop
-                    return (res == baud)
-
-        except Exception as e:
-            logging.critical("An exception was encountered in set_probe_baud_rate(): %s" % str(e))
-            return None
+        return self.__configure_one(id, 'baud', baud)
 
     """ Set probe running start stop
     """
     def set_probe_running(self, id, status):
         logging.debug("Function set_probe_running() - status: %s" % status)
-        try:
-            # find item
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # analyse data
-                # SA8340- 00     POWER ON                    4E
-                reg = 'SA8340.+LOG\sON\sTIME.+(START|STOP).+'
-                matches = re.match(reg, response)
-                if matches:
-                    # check if we need to increase or decrease the value
-                    cur_status = matches.group(1)
-                    logging.info("Status %s" % cur_status)
-
-                    if cur_status == status:
-                        logging.info("Running OK")
-                        return True
-
-                    if cur_status == 'START':
-                        if status == 'START':
-                            logging.info("Log format is correct - START")
-                            return True
-
-                        logging.info("Status turning OFF")
-                        response = self.serial_get_response(id+'D')
-                        logging.debug("-->> response %s" % response)
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
-
-                    elif cur_status == 'STOP':
-                        if status == 'STOP':
-                            logging.info("Log format is correct - STOP")
-                            return True
-                        logging.info("Status turning ON")
-                        response = self.serial_get_response(id+'U')
-                        logging.debug("-->> response %s" % response)
-                        response = self.serial_get_response(id+'I')
-                        logging.debug("-->> response %s" % response)
-
-                    return True
-                    # exit loop
-                    break
-
-        except Exception as e:
-            logging.critical("An exception was encountered in set_probe_status(): %s" % str(e))
-            return None
+        return self.__configure_one(id, 'run', status)
 
     """ Set probe status on off
     """
     def set_probe_status(self, id, status):
         logging.debug("Function set_probe_status() - status: %s" % status)
-        try:
-            # find item
-            for i in range(15):
-                if i==0:
-                    # enter calibration
-                    response = self.serial_get_response(id+'E')
-                else:
-                    response = self.serial_get_response(id+'M')
-
-                logging.debug("-> %02d response %s" % (i+1, response))
-                # analyse data
-                # SA8340- 00     POWER ON                    4E
-                reg = 'SA8340.+POWER\s(ON|OFF)\s+.+'
-                matches = re.match(reg, response)
-                if matches:
-                    # check if we need to increase or decrease the value
-                    cur_status = matches.group(1)
-                    logging.info("Status %s" % cur_status)
-
-                    if cur_status == status:
-                        logging.info("Status OK")
-                        return True
-
-                    if cur_status == 'ON':
-                        logging.info("Status turning OFF")
-                        response = self.serial_get_response(id+'D')
-                        logging.debug("-->> response %s" % response)
-
-                    elif cur_status == 'OFF':
-                        logging.info("Status turning ON")
-                        response = self.serial_get_response(id+'U')
-                        logging.debug("-->> response %s" % response)
-
-                    response = self.serial_get_response(id+'I')
-                    # SA8340- 00     POWER OFF       **WAIT**    2B
-                    logging.debug("-->> response %s" % response)
-
-                    # exit loop
-                    break
-
-        except Exception as e:
-            logging.critical("An exception was encountered in set_probe_status(): %s" % str(e))
-            return None
+        return self.__configure_one(id, 'status', status)
 
 
 
     """ Get data from probe
     """
     def probe_download_data(self, id, sensors, all):
+        return self.run(self.protocol_download_data(id, sensors, all))
+
+    """ Get data from probe, protocol operation
+    """
+    def protocol_download_data(self, id, sensors, all):
         logging.debug("Function probe_download_data()")
         try:
             # enable data transfer
-            response = self.serial_get_response(id+'T')
+            response = yield id+'T'
             logging.debug("Response %s" % response)
-            if not re.match('READY', response):
+            if parse_frame(response)[0] != FRAME_READY:
                 logging.warning("Wrong response from T command")
                 return False
 
             # get numbers of records
             logging.verbose("Get numbers of records")
-            response = self.serial_get_response(id+'N')
+            response = yield id+'N'
             logging.debug("Response %s" % response)
-            reg = '\s+(\d+)'
-            matches = re.match(reg, response)
-            if matches:
-                records_count = int(matches.group(1))
+            kind, fields = parse_frame(response)
+            if kind == FRAME_COUNT:
+                records_count = int(fields['count'])
             else:
                 records_count = 0
 
@@ -902,7 +1271,7 @@ class Client:
             # check fo no records,send A
             if records_count == 0:
                 # acquisizione continua
-                response = self.serial_get_response(id+'A')
+                response = yield id+'A'
                 logging.debug("response %s" % response)
                 logging.warning("no records found!")
                 return True
@@ -910,225 +1279,545 @@ class Client:
             # log
             logging.info("Record count %s" % records_count)
 
+            # resume after an aborted download, the sink only gets whole downloads:
+            # with a sink an aborted download is downloaded again
+            checkpoint = Checkpoint(self.data_path, id, self.conf.get('port', ''))
+            resume_key = None
+            resume_index = 0
+            if self.sink is None and checkpoint.load():
+                resume_key = checkpoint.key
+                resume_index = checkpoint.index
+                logging.info("Resuming after record %s of %s (%s)" % (checkpoint.index, checkpoint.records_count, checkpoint.date_time))
+                # an aborted 'all' download already stored every record
+                if all and checkpoint.mode == 'all' and checkpoint.records_count == records_count and checkpoint.index >= records_count:
+                    logging.info("All records already stored")
+                    response = yield id+'A'
+                    checkpoint.clear()
+                    return True
+            checkpoint.start(records_count, 'all' if all else 'last')
+
             # select download type
             logging.verbose("Select download type (last|all)")
             if all:
                 logging.info("Downloading all data")
-                response = self.serial_get_response(id+'G')
+                response = yield id+'G'
                 logging.debug("Response %s" % response)
-                if not re.match('G', response):
+                kind, fields = parse_frame(response)
+                if kind != FRAME_DOWNLOAD or fields['mode'] != b'G':
                     logging.warning("Wrong response from G command")
                     return False
             else:
                 logging.info("Downloading last data")
-                response = self.serial_get_response(id+'L')
+                response = yield id+'L'
                 logging.debug("Response %s" % response)
-                if not re.match('L', response):
+                kind, fields = parse_frame(response)
+                if kind != FRAME_DOWNLOAD or fields['mode'] != b'L':
                     logging.warning("Wrong response from L command")
                     return False
 
             # confirm command
             logging.verbose("Confirm command")
-            response = self.serial_get_response(id+'I')
+            response = yield id+'I'
 
             # take care of max
             if records_count > 1360:
                 records_count = 1360
 
-            # select reg expression by sensors
-            if int(sensors) == 5:
-                # livello, temperatura, conducibilità, pH, redox
-                reg = '(SA8340-\s(\d\d)\s(-?\d*(.\d+)?)\s(\d\d)\/(\d\d)\/(\d\d)\s(\d\d):(\d\d):(\d\d)\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+\d\d\/\d\d\/\d\d)(..)'
-                # Group 1.    0-101   `SA8340- 00 4.5 05/09/17 03:52:00  -0.005m      25.27øC     0.001mS     0.280pH     429.1mV   05/09/17`
-                # Group 2.    8-10    `00`
-                # Group 3.    11-14   `4.5`
-                # Group 4.    12-14   `.5`
-                # Group 5.    15-17   `05`
-                # Group 6.    18-20   `09`
-                # Group 7.    21-23   `17`
-                # Group 8.    24-26   `03`
-                # Group 9.    27-29   `52`
-                # Group 10.   30-32   `00`
-                # Group 11.   34-40   `-0.005`
-                # Group 12.   36-40   `.005`
-                # Group 13.   47-52   `25.27`
-                # Group 14.   49-52   `.27`
-                # Group 15.   59-64   `0.001`
-                # Group 16.   60-64   `.001`
-                # Group 17.   71-76   `0.280`
-                # Group 18.   72-76   `.280`
-                # Group 19.   83-88   `429.1`
-                # Group 20.   86-88   `.1`
-                # Group 21.   101-103 `F1`
-
-            elif int(sensors) == 4:
-                # livello, temperatura, conducibilità, pH
-                reg = '(SA8340-\s(\d\d)\s(-?\d*(.\d+)?)\s(\d\d)\/(\d\d)\/(\d\d)\s(\d\d):(\d\d):(\d\d)\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+\d\d\/\d\d\/\d\d)(..)'
-                # Full match    0-91    `SA8340- 20 4.3 27/06/18 11:50:00   0.002m      24.27øC    -0.001mS    -2.200pH   27/06/18CE`
-                # Group 1.  0-89    `SA8340- 20 4.3 27/06/18 11:50:00   0.002m      24.27øC    -0.001mS    -2.200pH   27/06/18`
-                # Group 2.  8-10    `20`
-                # Group 3.  11-14   `4.3`
-                # Group 4.  12-14   `.3`
-                # Group 5.  15-17   `27`
-                # Group 6.  18-20   `06`
-                # Group 7.  21-23   `18`
-                # Group 8.  24-26   `11`
-                # Group 9.  27-29   `50`
-                # Group 10. 30-32   `00`
-                # Group 11. 35-40   `0.002`
-                # Group 12. 36-40   `.002`
-                # Group 13. 47-52   `24.27`
-                # Group 14. 49-52   `.27`
-                # Group 15. 58-64   `-0.001`
-                # Group 16. 60-64   `.001`
-                # Group 17. 70-76   `-2.200`
-                # Group 18. 72-76   `.200`
-                # Group 19. 89-91   `CE`
-
-            else: # 3
-                # livello, temperatura, conducibilità, pH
-                reg = '(SA8340-\s(\d\d)\s(-?\d*(.\d+)?)\s(\d\d)\/(\d\d)\/(\d\d)\s(\d\d):(\d\d):(\d\d)\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+(-?\d*(.\d+)?).+?\s+\d\d\/\d\d\/\d\d)(..)'
-                # Group 1.    0-89    `SA8340- 05 4.5 14/09/17 12:34:38   0.000m      24.72øC     0.000mS     7.000pH   14/09/17`
-                # Group 2.    8-10    `05`
-                # Group 3.    11-14   `4.5`
-                # Group 4.    12-14   `.5`
-                # Group 5.    15-17   `14`
-                # Group 6.    18-20   `09`
-                # Group 7.    21-23   `17`
-                # Group 8.    24-26   `12`
-                # Group 9.    27-29   `34`
-                # Group 10.   30-32   `38`
-                # Group 11.   35-40   `0.000`
-                # Group 12.   36-40   `.000`
-                # Group 13.   47-52   `24.72`
-                # Group 14.   49-52   `.72`
-                # Group 15.   59-64   `0.000`
-                # Group 16.   60-64   `.000`
-                # Group 17.   71-76   `7.000`
-                # Group 18.   72-76   `.000`
-                # Group 19.   89-91   `C1`
-
-            # get all data
-            records = ''
-            cmd = 'N' # next record
-            error_count = 0
-            loop_count = 0
-            while loop_count < records_count + 1:
-                logging.debug("-> %02d getting record" % loop_count)
-
-                response = self.serial_get_response(id+cmd)
-                logging.debug("response %s" % response)
-                matches = re.match(reg, response)
-                if matches:
-                    record = matches.group(1)
-                    logging.verbose("record %s" % record)
-                    # select matches by sensors
-                    if int(sensors) == 5:
-                        bcc = matches.group(21)
-
-                    elif int(sensors) == 4:
-                        bcc = matches.group(19)
-
-                    else:
-                        bcc = matches.group(19)
-
-                    # compare bcc code
-                    if bcc != self.__get_bcc(record):
-                        # bcc wrong
-                        logging.warning('Bcc code does not much')
+            # records are streamed to file as they are validated
+            now = datetime.now()
+            # build filename with id and port, the same id may be downloaded on another port
+            fileName = os.path.join(self.data_path, "SondaID-"+id+"_"+port_tag(self.conf.get('port', ''))+"_"+now.strftime('%Y%m%d-%H%M%S')+".dat")
+            writer = RecordWriter(fileName, on_sync=checkpoint.save if self.sink is None else None)
+            download = Download(writer, checkpoint, resume_key, resume_index, id, sensors, self.sink, self.conf.get('port', ''))
+
+            # receive stage: check bcc and ask the next record as soon as a frame is complete,
+            # frames are parsed and stored by the transport store stage
+            completed = False
+            frames = []
+            try:
+                cmd = 'N' # next record
+                error_count = 0
+                loop_count = 0
+                while loop_count < records_count + 1:
+                    # store stage failed, stop asking records
+                    if download.failed:
+                        break
+
+                    response = yield id+cmd
+                    if response.startswith(b'SA8340-'):
+                        # compare bcc code, the probe can only repeat the last record
+                        if response[-2:] != get_bcc(memoryview(response)[:-2]):
+                            # bcc wrong
+                            logging.warning('Bcc code does not much')
+                            if self.metrics is not None:
+                                self.metrics.bcc_error(self.conf.get('port', ''), id)
+                            # set next call command
+                            cmd = 'P' # send record again
+                            # increment errors counter
+                            error_count += 1
+                            if error_count > 10:
+                                logging.error('Too many errors, stop downloading.')
+                                if self.trace is not None:
+                                    self.trace.dump("too many errors", force=True)
+                                # end
+                                break
+                            continue
+
+                        # increment record count
+                        loop_count += 1
+                        # bcc ok, hand over to the store stage
+                        frames.append((loop_count, response))
+                        if len(frames) >= Download.BATCH_SIZE:
+                            yield (ACTION_STORE, download, frames)
+                            frames = []
                         # set next call command
-                        cmd = 'P' # send record again
-                        # increment errors counter
-                        error_count += 1
-                        if error_count > 10:
-                            logging.error('Too many errors, stop downloading.')
-                            # end
-                            break
-                    else:
-                        # bcc ok, valid data
-                        logging.verbose('Bcc code is ok')
-
-                        # get date time
-                        date_time = '20'+matches.group(7)+'-'+matches.group(6)+'-'+matches.group(5)
-                        date_time += ' '+matches.group(8)+':'+matches.group(9)+':'+matches.group(10)
-
-                        # get values
-                        values = []
-                        # 5 sensors probe only
-                        if int(sensors) == 5:
-                            values = [matches.group(11)]
-                            values.append( matches.group(13) );
-                            values.append( matches.group(15) );
-                            values.append( matches.group(17) );
-                            values.append( matches.group(19) );
-                        elif int(sensors) == 4:
-                            values = [matches.group(11)]
-                            values.append( matches.group(13) );
-                            values.append( matches.group(15) );
-                            values.append( matches.group(17) );
-                        else:
-                            values = [matches.group(11)]
-                            values.append( matches.group(13) );
-                            values.append( matches.group(15) );
-
-                        # build record, id + date + values
-                        rec = id + self.SEMICOLON + date_time + self.SEMICOLON + self.SEMICOLON.join(values)
-                        logging.verbose('Record <%s>' % rec)
-                        # test record
-                        if records == '':
-                            # empty no cr
-                            records = rec
-                        else:
-                            records += self.CR + rec
-
-                    # increment record count
-                    loop_count += 1
-                    # set next call command
-                    cmd = 'N' # next record
-
-                elif re.match('STOP', response):
-                    logging.verbose("Select download type for resetting pointer counter (last|all)")
-                    if all:
-                        # no reset probe
-                        logging.info("Pointer reset not required")
-                        response = self.serial_get_response(id+'A')
-                        logging.debug("Response %s" % response)
-                    else:
-                        logging.info("Reset pointer")
-                        response = self.serial_get_response(id+'Z')
-                        logging.debug("Response %s" % response)
+                        cmd = 'N' # next record
 
-                    # end
-                    break
+                    elif parse_frame(response)[0] == FRAME_STOP:
+                        completed = True
+                        download.completed = True
+                        # end
+                        break
 
+                    else:
+                        # end
+                        logging.warning("Record does not match regular expression, check probe type")
+                        break
+
+            finally:
+                if frames:
+                    yield (ACTION_STORE, download, frames)
+                # make downloaded records durable, records of a completed download in the sink
+                durable = yield (ACTION_FINISH, download)
+                if checkpoint.date_time is not None:
+                    self.last_records[id] = checkpoint.date_time.decode()
+
+            # reset pointer only once data is on disk
+            if completed and durable and not download.failed:
+                logging.verbose("Select download type for resetting pointer counter (last|all)")
+                if all:
+                    # no reset probe
+                    logging.info("Pointer reset not required")
+                    response = yield id+'A'
+                    logging.debug("Response %s" % response)
                 else:
-                    # end
-                    logging.warning("Record does not match regular expression, check probe type")
-                    break
+                    logging.info("Reset pointer")
+                    response = yield id+'Z'
+                    logging.debug("Response %s" % response)
+
+                # nothing left to resume
+                checkpoint.clear()
 
             # acquisizione continua
-            response = self.serial_get_response(id+'A')
+            response = yield id+'A'
+
+            # records of an aborted download are in the file only
+            if self.sink is not None and not (completed and durable):
+                logging.warning("Download not completed, records not stored")
+                return False
 
-            # check for valid data - records lenght: 38 for 3 params probe
-            logging.verbose("Records lenght: %s" % len(records))
-            if (len(records) == 0 ):
+            # check for valid data
+            logging.verbose("Records count: %s" % writer.count)
+            if writer.count == 0:
                 # end
+                if resume_key and completed:
+                    logging.info("No new data since last download")
+                    return True
                 logging.warning("No data downloaded!")
                 return False
 
-            # date time & measure time for db
-            now = datetime.now()
-            # build filename with id
-            fileName = os.path.join(self.data_path, "SondaID-"+id+"_"+now.strftime('%Y%m%d-%H%M%S')+".dat")
-            with open(fileName, 'a') as the_file:
-                the_file.write(records)
+            logging.info("%s records written to %s" % (writer.count, fileName))
 
             # return ok
             return True
 
         except Exception as e:
             logging.critical("An exception was encountered in probe_download_data(): %s" % str(e))
+            if self.trace is not None:
+                self.trace.dump("exception in probe_download_data(): %s" % str(e), force=True)
+            return False
+
+
+# download store stage - parses validated frames and writes their records, off the serial path
+class Download:
+    """ Constants
+    """
+    SEMICOLON  = b";"
+    BATCH_SIZE = 20  # frames handed to the store stage at once
+
+    """ Init
+    """
+    def __init__(self, writer, checkpoint, resume_key, resume_index, id, sensors, sink=None, port=''):
+        self.writer = writer
+        self.checkpoint = checkpoint
+        # last record stored by an aborted download, its time and index
+        self.resume_key = resume_key
+        self.resume_index = resume_index
+        # records are built and written as bytes, no decoding
+        self.id = id.encode()
+        self.sensors = int(sensors)
+        # in process ingestion, probe_sink.RecordSink, records kept until the download completed
+        self.sink = sink
+        self.port = port_tag(port)
+        self.records = []
+        # set on a wrong record, following frames are skipped
+        self.failed = False
+        # set by the receive stage on the end of records
+        self.completed = False
+
+    """ Get record sort key yymmddHH:MM:SS from fixed columns, no parsing
+    """
+    @staticmethod
+    def record_key(response):
+        # SA8340- 00 5.1 29/03/17 14:03:00 ...
+        return response[21:23] + response[18:20] + response[15:17] + response[24:32]
+
+    """ Parse and store a batch of (index, frame), return False once the download failed
+    """
+    def store(self, frames):
+        for index, response in frames:
+            # skip remaining frames after an error
+            if self.failed:
+                return False
+
+            try:
+                key = self.record_key(response)
+                # already stored by an aborted download, drop without parsing, records
+                # after it are kept even if older: the probe clock may have been set back
+                if self.resume_key and index <= self.resume_index and key <= self.resume_key:
+                    self.checkpoint.mark(index, None, None)
+                    continue
+
+                logging.debug("response %s", response)
+                kind, fields = parse_frame(response)
+                if kind != FRAME_RECORD or len(fields['values']) < self.sensors:
+                    logging.warning("Record does not match regular expression, check probe type")
+                    self.failed = True
+                    continue
+
+                logging.verbose("record %s", fields['record'])
+
+                # get date time
+                date_time = b'20%s-%s-%s %s:%s:%s' % (fields['year'], fields['month'], fields['day'], fields['hour'], fields['minute'], fields['second'])
+
+                # get values, by sensors
+                values = fields['values'][:self.sensors]
+
+                # build record, id + date + values
+                rec = self.id + self.SEMICOLON + date_time + self.SEMICOLON + self.SEMICOLON.join(values)
+                logging.verbose('Record <%s>', rec)
+                self.writer.write(rec)
+                if self.sink is not None:
+                    self.records.append((date_time, values))
+                self.checkpoint.mark(index, key, date_time)
+
+            except Exception as e:
+                logging.critical("An exception was encountered in Download.store(): %s" % str(e))
+                self.failed = True
+
+        return not self.failed
+
+    """ Make records durable and hand a completed download to the sink,
+        return True when all records are durable
+    """
+    def finish(self):
+        durable = self.writer.close()
+        if self.sink is None:
+            return durable
+        # whole download in the sink, written in one transaction, none of an aborted one
+        if not (durable and self.completed and not self.failed):
             return False
+        records, self.records = self.records, []
+        return not records or self.sink.put(self.port, self.id, records)
+
+
+# download file writer - streams records to disk as they are validated
+class RecordWriter:
+    """ Constants
+    """
+    CR = b"\r"
+    BUFFER_SIZE = 64*1024  # write buffer
+    SYNC_EVERY  = 100      # records between fsync
+
+    """ Init
+    """
+    def __init__(self, file_name, sync_every=SYNC_EVERY, on_sync=None):
+        logging.debug("RecordWriter init - file: %s" % file_name)
+
+        self.file_name = file_name
+        self.sync_every = sync_every
+        # called once records are durable
+        self.on_sync = on_sync
+        self.file = None
+        self.count = 0
+
+    """ Append one record (bytes), the file is created on first record
+    """
+    def write(self, rec):
+        if self.file is None:
+            self.file = open(self.file_name, 'ab', self.BUFFER_SIZE)
+            self.file.write(rec)
+        else:
+            self.file.write(self.CR + rec)
+
+        self.count += 1
+        if self.count % self.sync_every == 0:
+            self.sync()
+
+    """ Flush buffers and force data on disk
+    """
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            logging.verbose("Synced %s records to %s" % (self.count, self.file_name))
+        if self.on_sync is not None:
+            self.on_sync()
+
+    """ Sync and close file, return True when all records are durable
+    """
+    def close(self):
+        logging.debug("Function RecordWriter.close()")
+        try:
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+            return True
+
+        except Exception as e:
+            logging.critical("An exception was encountered in RecordWriter.close(): %s" % str(e))
+            return False
+
+
+# probe response latency - smoothed round trip and its variation, as for TCP retransmissions
+class ResponseTimer:
+    """ Constants
+    """
+    ALPHA = 0.125  # round trip gain
+    BETA  = 0.25   # variation gain
+    K     = 4      # variations added to the round trip
+
+    """ Init
+    """
+    def __init__(self, initial, floor, ceiling):
+        self.initial = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        # no sample yet
+        self.srtt = None
+        self.rttvar = None
+
+    """ Restore a saved estimate
+    """
+    def restore(self, srtt, rttvar):
+        self.srtt = float(srtt)
+        self.rttvar = float(rttvar)
+
+    """ Add a response latency sample (seconds)
+    """
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+    """ No answer in time, widen the variation
+    """
+    def expired(self):
+        if self.rttvar is not None:
+            self.rttvar = min(self.rttvar * 2, self.ceiling)
+
+    """ First answer deadline (seconds)
+    """
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial
+        return min(self.ceiling, max(self.floor, self.srtt + self.K * self.rttvar))
+
+    """ Gap between retries (seconds)
+    """
+    def pacing(self, floor, ceiling):
+        if self.srtt is None:
+            return ceiling
+        return min(ceiling, max(floor, self.srtt / 2))
+
+
+# download checkpoint - last record made durable for a probe id on a port
+class Checkpoint:
+    """ Init
+    """
+    def __init__(self, data_path, id, port=''):
+        # the same id may be used on other ports, downloaded at the same time
+        self.file_name = os.path.join(data_path, "SondaID-"+id+"_"+port_tag(port)+".ckpt")
+        # last good record index in the download and its key/date
+        self.index = 0
+        self.key = None
+        self.date_time = None
+        # download the index refers to
+        self.records_count = 0
+        self.mode = None
+
+    """ Load checkpoint, return True if one exists
+    """
+    def load(self):
+        logging.debug("Function Checkpoint.load() - file: %s" % self.file_name)
+        try:
+            if not os.path.exists(self.file_name):
+                return False
+            with open(self.file_name, 'r') as the_file:
+                data = json.load(the_file)
+            self.index = int(data['index'])
+            self.key = data['key'].encode('latin1')
+            self.date_time = data['date_time'].encode('latin1')
+            self.records_count = int(data['records_count'])
+            self.mode = data['mode']
+            return self.key is not None
+
+        except Exception as e:
+            logging.warning("Invalid checkpoint %s: %s" % (self.file_name, str(e)))
+            return False
+
+    """ Start a new download, keeping the last stored record
+    """
+    def start(self, records_count, mode):
+        self.index = 0
+        self.records_count = records_count
+        self.mode = mode
+
+    """ Record index as handled, key/date only when a new record was stored
+    """
+    def mark(self, index, key, date_time):
+        self.index = index
+        if key is not None:
+            self.key = key
+            self.date_time = date_time
+
+    """ Persist checkpoint atomically
+    """
+    def save(self):
+        if self.key is None:
+            return
+        data = {
+            'index'         : self.index,
+            'key'           : self.key.decode('latin1'),
+            'date_time'     : self.date_time.decode('latin1'),
+            'records_count' : self.records_count,
+            'mode'          : self.mode,
+        }
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'w') as the_file:
+            json.dump(data, the_file)
+            the_file.flush()
+            os.fsync(the_file.fileno())
+        os.replace(tmp_name, self.file_name)
+        logging.verbose("Checkpoint saved - record %s, %s" % (self.index, self.date_time))
+
+    """ Remove checkpoint, download completed
+    """
+    def clear(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+            logging.debug("Checkpoint removed %s" % self.file_name)
+
+
+# probe configuration - calibration menu items as typed values
+class ConfigSnapshot:
+    """ Init
+    """
+    def __init__(self):
+        self.taken = time.time()
+        # raw menu lines, as sent by the probe
+        self.lines = []
+        # LOG ON TIME 59m START
+        self.log_value = None
+        self.log_unit = None
+        self.log_state = None
+        # REC INST.  1354 REC UTIL. 44433
+        self.rec_inst = None
+        self.rec_util = None
+        # MAIN  B. 5.1V OK
+        self.battery_voltage = None
+        self.battery_status = None
+        # TIME  22/03/17        13:38:52
+        self.time = None
+        # instant values
+        self.level = None
+        self.temp = None
+        self.cond = None
+        self.ph = None
+        self.redox = None
+        # RT CONT.:   10 s
+        self.rt_cont = None
+        # TIMEOUT ON STARTPROFILE: 10m
+        self.timeout = None
+        self.timeout_unit = None
+        # POWER ON
+        self.power = None
+        # SA8340 R2.63    ID: 00
+        self.release = None
+        self.probe_id = None
+        # BAUD RATE:  9600
+        self.baud = None
+
+    """ Add one menu item
+    """
+    def add(self, response, kind, fields):
+        self.lines.append(response.decode('latin1'))
+        if kind is None:
+            return
+        fields = decode_fields(fields)
+
+        if kind == FRAME_LOG_ON_TIME:
+            self.log_value = int(fields['value'])
+            self.log_unit = fields['unit']
+            self.log_state = fields['state']
+        elif kind == FRAME_REC:
+            self.rec_inst = int(fields['rec_inst'])
+            self.rec_util = int(fields['rec_util'])
+        elif kind == FRAME_BATTERY:
+            # first line has no reading yet
+            if fields['voltage'] is not None:
+                self.battery_voltage = float(fields['voltage'])
+                self.battery_status = fields['status']
+        elif kind == FRAME_TIME:
+            self.time = datetime.strptime('%(day)s/%(month)s/%(year)s %(hour)s:%(minute)s:%(second)s' % fields, '%d/%m/%y %H:%M:%S')
+        elif kind == FRAME_LEVEL:
+            self.level = float(fields['value'])
+        elif kind == FRAME_TEMP:
+            self.temp = float(fields['value'])
+        elif kind == FRAME_COND:
+            self.cond = float(fields['value'])
+        elif kind == FRAME_PH:
+            self.ph = float(fields['value'])
+        elif kind == FRAME_REDOX:
+            self.redox = float(fields['value'])
+        elif kind == FRAME_RT_CONT:
+            self.rt_cont = int(fields['value'])
+        elif kind == FRAME_TIMEOUT:
+            self.timeout = int(fields['value'])
+            self.timeout_unit = fields['unit']
+        elif kind == FRAME_POWER:
+            self.power = fields['state']
+        elif kind == FRAME_ID:
+            self.release = fields['release']
+            self.probe_id = fields['probe_id']
+        elif kind == FRAME_BAUD:
+            self.baud = int(fields['baud'])
+
+    """ Seconds since the menu walk
+    """
+    def age(self):
+        return time.time() - self.taken
+
+    """ Probe clock now, from the time read during the walk
+    """
+    def probe_time(self):
+        if self.time is None:
+            return None
+        return self.time + timedelta(seconds=int(self.age()))
 
 
 #
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics instrument support functions, asyncio client
+#  File : probe_bc_8340_async.py
+#
+#  Install: sudo pip3 install pyserial
+# ----------------------------------------------------------------------
+""" Asyncio transport of probe_bc_8340.Client, Python 3 and POSIX only.
+    The serial file descriptor is registered with the event loop, so one
+    process can drive many ports without a thread per port.
+
+    The protocol operations are the Client ones (Client.protocol_*), run
+    here with awaited serial IO; file writes and the sink run in the
+    default executor.
+
+    One client is one bus: operations on the same client must not be
+    interleaved, hold client.lock when sharing it between tasks.
+
+    async def poll(conf, data_path):
+        client = AsyncClient(conf, data_path)
+        if client.serial_open():
+            if await client.probe_wakeup('18'):
+                await client.probe_download_data('18', 3, False)
+            client.serial_close()
+"""
+
+""" Imports
+"""
+import sys
+import os
+import logging
+import time
+import asyncio
+# ecometer modules
+from probe_bc_8340 import Client, ACTION_SLEEP, ACTION_STORE, ACTION_FINISH
+
+if __name__ == '__main__':
+    sys.exit(1)
+
+
+# asyncio client - same operations as Client, as coroutines
+class AsyncClient(Client):
+    """ Constants
+    """
+    READ_SIZE = 4096  # bytes read when the descriptor is readable
+
+    """ Init
+    """
+    def __init__(self, conf, data_path, loop=None):
+        Client.__init__(self, conf, data_path)
+        self.loop = loop
+        # set by the reader when data arrives
+        self.rx_event = None
+        # arrival of first and last data since the last command
+        self.rx_first = None
+        self.rx_last = None
+        # download batch being stored in the executor
+        self.storing = None
+        # one operation at a time on the bus
+        self.lock = None
+
+
+    """ SERIAL STUFF
+    """
+
+    """ Open serial port and register it with the running event loop
+    """
+    def serial_open(self):
+        logging.debug("Function AsyncClient.serial_open()")
+        if self.loop is None:
+            try:
+                self.loop = asyncio.get_running_loop()
+            except RuntimeError:
+                logging.critical("AsyncClient.serial_open() called outside a running event loop")
+                return False
+
+        if not Client.serial_open(self):
+            return False
+
+        if self.fd is None:
+            logging.critical("No file descriptor for %s, asyncio client needs POSIX" % self.conf['port'])
+            Client.serial_close(self)
+            return False
+
+        self.rx_event = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.loop.add_reader(self.fd, self.__on_readable)
+        return True
+
+    """ Unregister and close serial port
+    """
+    def serial_close(self):
+        if self.fd is not None and self.loop is not None and not self.loop.is_closed():
+            self.loop.remove_reader(self.fd)
+        return Client.serial_close(self)
+
+    """ Event loop callback, move available bytes to the receive buffer
+    """
+    def __on_readable(self):
+        try:
+            data = os.read(self.fd, self.READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.critical("An exception was encountered in AsyncClient.__on_readable(): %s" % str(e))
+            self.loop.remove_reader(self.fd)
+            return
+
+        if data:
+            self.rx_last = time.time()
+            if self.rx_first is None:
+                self.rx_first = self.rx_last
+            self.rx_buffer += data
+            self.rx_event.set()
+
+    """ Send command and read response frame (bytes), empty on timeout
+    """
+    async def serial_get_frame(self, command):
+        logging.verbose("Function AsyncClient.serial_get_frame()")
+        logging.verbose("Command %s", command)
+        try:
+            # check if port is opened
+            if not self.ser or not self.ser.isOpen():
+                logging.warning("Serial port not opened")
+                return b''
+
+            exchange = self.serial_exchange(command)
+            data = next(exchange)
+            # abort current output, a command is a few bytes, no need to drain
+            self.ser.flushOutput()
+            logging.verbose("Sending serial command TX[%s]", command)
+            self.rx_first = None
+            self.rx_event.clear()
+            self.ser.write(data)
+
+            deadline = exchange.send(None)
+            while True:
+                # the reader sets rx_event for data received since the last look
+                if not self.rx_event.is_set():
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        try:
+                            await asyncio.wait_for(self.rx_event.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            pass
+                arrival = None
+                if self.rx_event.is_set():
+                    self.rx_event.clear()
+                    arrival = (self.rx_first, self.rx_last)
+                deadline = exchange.send(arrival)
+
+        except StopIteration as e:
+            return e.value
+
+        except Exception as e:
+            logging.critical("An exception was encountered in AsyncClient.serial_get_frame(): %s" % str(e))
+            if self.trace is not None:
+                self.trace.dump("exception in serial_get_frame(): %s" % str(e), force=True)
+            return b''
+
+    """ Read value from instrument, as text
+    """
+    async def serial_get_response(self, command):
+        return (await self.serial_get_frame(command)).decode('latin1')
+
+
+    """ PROTOCOL DRIVER
+    """
+
+    """ Run a protocol operation with awaited serial IO, return its result
+    """
+    async def run(self, operation):
+        result = None
+        error = None
+        while True:
+            try:
+                if error is not None:
+                    action = operation.throw(error)
+                else:
+                    action = operation.send(result)
+            except StopIteration as e:
+                return e.value
+
+            result = None
+            error = None
+            try:
+                result = await self.__perform(action)
+            except Exception as e:
+                # raised where the operation asked for it
+                error = e
+
+    """ Perform one action of a protocol operation
+    """
+    async def __perform(self, action):
+        # command, answered with the response frame
+        if isinstance(action, str):
+            return await self.serial_get_frame(action)
+
+        kind = action[0]
+        if kind == ACTION_SLEEP:
+            await asyncio.sleep(action[1])
+            return None
+
+        if kind == ACTION_STORE:
+            # one batch stored while the next one is received
+            download, frames = action[1:]
+            if self.storing is not None:
+                await self.storing
+            self.storing = self.loop.run_in_executor(None, download.store, frames)
+            return not download.failed
+
+        if kind == ACTION_FINISH:
+            if self.storing is not None:
+                storing, self.storing = self.storing, None
+                await storing
+            return await self.loop.run_in_executor(None, action[1].finish)
+
+        raise ValueError("unknown protocol action %s" % kind)
+
+
+    """ PROBE STUFF
+    """
+
+    """ Wake up probe
+    """
+    async def probe_wakeup(self, id):
+        return await self.run(self.protocol_wakeup(id))
+
+    """ Switch off probe
+    """
+    async def probe_switch_off(self):
+        return await self.run(self.protocol_switch_off())
+
+
+    """ PROBE GETTERS
+    """
+
+    """ Get configuration snapshot, one menu walk reused for config_ttl seconds
+    """
+    async def get_probe_snapshot(self, id, refresh=False):
+        return await self.run(self.protocol_snapshot(id, refresh))
+
+    """ Get probe id
+    """
+    async def get_probe_id(self, id):
+        logging.debug("Function get_probe_id()")
+        snapshot = await self.get_probe_snapshot(id)
+        if snapshot is None:
+            return None
+        return snapshot.probe_id
+
+    """ Read main configuration
+    """
+    async def get_probe_configuration(self, id):
+        logging.debug("Function get_probe_configuration()")
+        snapshot = await self.get_probe_snapshot(id)
+        if snapshot is None:
+            return None
+        return self.CRLF + ''.join(line + self.CRLF for line in snapshot.lines)
+
+    """ Get probe baud rate
+    """
+    async def get_probe_baud_rate(self, id):
+        logging.debug("Function get_probe_baud_rate()")
+        snapshot = await self.get_probe_snapshot(id)
+        if snapshot is None or snapshot.baud is None:
+            return None
+        return str(snapshot.baud)
+
+    """ Get probe date
+    """
+    async def get_probe_date(self, id):
+        logging.debug("Function get_probe_date()")
+        snapshot = await self.get_probe_snapshot(id)
+        if snapshot is None or snapshot.time is None:
+            return None
+        # probe clock kept running since the snapshot
+        return snapshot.probe_time().strftime('%d/%m/%y %H:%M:%S')
+
+
+    """ PROBE SETTERS
+    """
+
+    """ Apply several settings in one menu walk, return {setting: result}
+        settings as for Client.probe_configure
+    """
+    async def probe_configure(self, id, settings):
+        return await self.run(self.protocol_configure(id, settings))
+
+    """ Apply one setting, return its result
+    """
+    async def __configure_one(self, id, key, value):
+        results = await self.probe_configure(id, {key: value})
+        if results is None:
+            return None
+        return results.get(key)
+
+    """ Set probe id
+    """
+    async def set_probe_id(self, id, newid):
+        return await self.__configure_one(id, 'id', newid)
+
+    """ Set probe time
+    """
+    async def set_probe_date_time(self, id, date, time):
+        return await self.__configure_one(id, 'date_time', (date, time))
+
+    """ Set probe log time format Minutes|Hours
+    """
+    async def set_probe_log_time_format(self, id, format):
+        return await self.__configure_one(id, 'log_format', format)
+
+    """ Set probe log time
+    """
+    async def set_probe_log_time(self, id, value):
+        return await self.__configure_one(id, 'log_value', value)
+
+    """ Set probe serial baud rate
+    """
+    async def set_probe_baud_rate(self, id, baud):
+        return await self.__configure_one(id, 'baud', baud)
+
+    """ Set probe running start stop
+    """
+    async def set_probe_running(self, id, status):
+        return await self.__configure_one(id, 'run', status)
+
+    """ Set probe status on off
+    """
+    async def set_probe_status(self, id, status):
+        return await self.__configure_one(id, 'status', status)
+
+
+    """ PROBE DATA
+    """
+
+    """ Get data from probe
+    """
+    async def probe_download_data(self, id, sensors, all):
+        return await self.run(self.protocol_download_data(id, sensors, all))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics records, columnar files
+#  File : probe_columns.py
+# ----------------------------------------------------------------------
+""" Typed per-channel arrays of downloaded records, one file set per probe
+    download (the sink writes a download whole), named by port and first
+    record time. A later download starting at the same record, as a new
+    'all' download, is merged into the set of the earlier one:
+
+    arrow: data/SondaID-18_COM5_20170329-140300.arrow, Arrow IPC file (pyarrow)
+           pyarrow.ipc.open_file(pyarrow.memory_map(file_name)).read_all()
+    npy:   data/SondaID-18_COM5_20170329-140300/<channel>.npy (numpy)
+           numpy.load(file_name, mmap_mode='r')
+
+    Channels: time (int64, epoch seconds of the probe clock taken as UTC),
+    level, temp, cond, ph, redox (float32, NaN when missing), as many as
+    the probe sensors.
+
+    Sets are replaced at once, written to <name>.tmp first: readers never
+    see a partial set, an npy set may be missing while it is swapped.
+
+    Used as probe_sink backend 'columns'.
+"""
+
+""" Imports
+"""
+import sys
+import os
+import logging
+import time
+import calendar
+import shutil
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if __name__ == '__main__':
+    sys.exit(1)
+
+
+# columnar writer - arrow when available, else numpy
+class ColumnarBackend:
+    """ Constants
+    """
+    CHANNELS = ('level', 'temp', 'cond', 'ph', 'redox', 'value6')
+    FORMATS  = ('arrow', 'npy')  # by preference
+
+    """ Init
+    """
+    def __init__(self, data_path, format=None):
+        available = [name for name, module in zip(self.FORMATS, (pyarrow, numpy)) if module is not None]
+        if not available:
+            raise ImportError("columnar output requires pyarrow or numpy")
+        if format is None:
+            format = available[0]
+        elif format not in available:
+            raise ImportError("columnar format %s not available, one of %s" % (format, ', '.join(available)))
+        logging.debug("ColumnarBackend init - format: %s" % format)
+
+        self.data_path = data_path
+        self.format = format
+
+    """ Write records, one file set per port and probe download
+    """
+    def write(self, records):
+        by_probe = {}
+        for port, probe_id, date_time, values in records:
+            by_probe.setdefault((port, probe_id), {})[calendar.timegm(time.strptime(date_time, '%Y-%m-%d %H:%M:%S'))] = values
+
+        if self.format == 'arrow':
+            read, write = self.__read_arrow, self.__write_arrow
+        else:
+            read, write = self.__read_npy, self.__write_npy
+
+        for (port, probe_id), rows in by_probe.items():
+            name = "SondaID-%02d_%s_%s" % (probe_id, port, time.strftime('%Y%m%d-%H%M%S', time.gmtime(min(rows))))
+            # set of an earlier download from the same record, new values win
+            stored = read(name)
+            if stored:
+                stored.update(rows)
+                rows = stored
+
+            times = sorted(rows)
+            width = max(len(values) for values in rows.values())
+            nan = float('nan')
+            columns = [[rows[t][k] if k < len(rows[t]) else nan for t in times] for k in range(width)]
+            write(name, times, columns)
+            logging.verbose("Columnar %s, %d records" % (name, len(times)))
+
+    """ Records of an arrow set, {time: values}, empty if none
+    """
+    def __read_arrow(self, name):
+        file_name = os.path.join(self.data_path, name + ".arrow")
+        if not os.path.exists(file_name):
+            return {}
+        with pyarrow.memory_map(file_name) as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        columns = [table.column(channel).to_pylist() for channel in table.column_names]
+        return dict((row[0], row[1:]) for row in zip(*columns))
+
+    """ Arrow IPC file, uncompressed to be memory mapped
+    """
+    def __write_arrow(self, name, times, columns):
+        arrays = [pyarrow.array(times, type=pyarrow.int64())]
+        arrays += [pyarrow.array(column, type=pyarrow.float32()) for column in columns]
+        table = pyarrow.Table.from_arrays(arrays, names=('time',) + self.CHANNELS[:len(columns)])
+        file_name = os.path.join(self.data_path, name + ".arrow")
+        temp = file_name + ".tmp"
+        with pyarrow.OSFile(temp, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp, file_name)
+
+    """ Records of an npy set, {time: values}, empty if none
+    """
+    def __read_npy(self, name):
+        path = os.path.join(self.data_path, name)
+        if not os.path.exists(path):
+            return {}
+        columns = [numpy.load(os.path.join(path, "time.npy")).tolist()]
+        for channel in self.CHANNELS:
+            file_name = os.path.join(path, channel + ".npy")
+            if not os.path.exists(file_name):
+                break
+            columns.append(numpy.load(file_name).tolist())
+        return dict((row[0], row[1:]) for row in zip(*columns))
+
+    """ One .npy per channel in a directory, swapped with the previous one
+    """
+    def __write_npy(self, name, times, columns):
+        path = os.path.join(self.data_path, name)
+        temp = path + ".tmp"
+        if os.path.exists(temp):
+            shutil.rmtree(temp)
+        os.mkdir(temp)
+        numpy.save(os.path.join(temp, "time.npy"), numpy.array(times, dtype=numpy.int64))
+        for channel, column in zip(self.CHANNELS, columns):
+            numpy.save(os.path.join(temp, channel + ".npy"), numpy.array(column, dtype=numpy.float32))
+        # a directory cannot be replaced while not empty
+        if os.path.exists(path):
+            old = path + ".old"
+            if os.path.exists(old):
+                shutil.rmtree(old)
+            os.replace(path, old)
+            os.replace(temp, path)
+            shutil.rmtree(old)
+        else:
+            os.replace(temp, path)
+
+    """ Nothing kept open
+    """
+    def close(self):
+        pass
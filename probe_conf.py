@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding=utf8
 # -*- coding: utf8 -*-
 # vim: set fileencoding=utf8 :
@@ -37,6 +37,7 @@ Usage:
     probe_conf.py [-v ...] [options] set_run (start|stop)
     probe_conf.py [-v ...] [options] set_status (on|off)
     probe_conf.py [-v ...] [options] switch_off
+    probe_conf.py [-v ...] [options] apply <setting>...
     probe_conf.py [-v ...] [options] get_data <sensors> (last|all)
     probe_conf.py (-h | --help)
 
@@ -54,6 +55,10 @@ Arguments:
     set_run         Set probe running (start|stop)
     set_status      Set probe status (on|off)
     switch_off      Switch off probe
+    apply           Apply several settings in one pass, <setting> as name=value
+                    # baud=<baud> id=<newid> date=<YYYY-MM-DD> time=<HH:MM>
+                    # date=gmt1 log_format=(hours|minutes) log_value=<value>
+                    # run=(start|stop) status=(on|off)
     get_data        Get probe data
                     # <sensors> number of sensors 3|5
                     # (last|all) download last data or all data
@@ -271,6 +276,82 @@ def probe_switch_off(id):
         logging.info("Probe result: %s" % res)
 
 
+# apply setting names, as in the usage
+SETTING_NAMES = ('baud', 'id', 'date', 'time', 'log_format', 'log_value', 'run', 'status')
+
+""" Parse name=value settings for probe_configure, checked before the port is opened
+    raise ValueError on an unknown name or an invalid value
+"""
+def parse_settings(items):
+    values = {}
+    for item in items:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError("setting %s is not name=value" % item)
+        if name not in SETTING_NAMES:
+            raise ValueError("unknown setting %s, one of %s" % (name, ', '.join(SETTING_NAMES)))
+        if name in values:
+            raise ValueError("setting %s given twice" % name)
+        values[name] = value
+
+    def choice(name, allowed):
+        if values[name].lower() not in allowed:
+            raise ValueError("invalid %s=%s, one of %s" % (name, values[name], '|'.join(allowed)))
+        return values[name].lower()
+
+    def number(name, allowed):
+        try:
+            value = int(values[name])
+        except ValueError:
+            value = None
+        if value not in allowed:
+            raise ValueError("invalid %s=%s, %s to %s" % (name, values[name], allowed[0], allowed[-1]))
+        return value
+
+    settings = {}
+    if 'baud' in values:
+        bauds = probe_bc_8340.STEP_FIELDS[probe_bc_8340.FRAME_CAL_BAUD][0]
+        if values['baud'] not in [str(baud) for baud in bauds]:
+            raise ValueError("invalid baud=%s, one of %s" % (values['baud'], '|'.join(str(baud) for baud in bauds)))
+        settings['baud'] = int(values['baud'])
+    if 'id' in values:
+        settings['id'] = number('id', probe_bc_8340.STEP_FIELDS[probe_bc_8340.FRAME_CAL_ID][0])
+    if values.get('date') == 'gmt1':
+        if 'time' in values:
+            raise ValueError("time is taken from the clock with date=gmt1")
+        now = datetime.utcnow() + timedelta(hours=1)
+        # <YYYY-MM-DD> <HH:MM>
+        settings['date_time'] = (now.strftime('%Y-%m-%d'), now.strftime('%H:%M'))
+    elif 'date' in values or 'time' in values:
+        if 'date' not in values or 'time' not in values:
+            raise ValueError("date=<YYYY-MM-DD> and time=<HH:MM> go together")
+        try:
+            datetime.strptime(values['date'] + ' ' + values['time'], '%Y-%m-%d %H:%M')
+        except ValueError:
+            raise ValueError("invalid date=%s time=%s, <YYYY-MM-DD> <HH:MM>" % (values['date'], values['time']))
+        settings['date_time'] = (values['date'], values['time'])
+    if 'log_format' in values:
+        settings['log_format'] = choice('log_format', ('hours', 'minutes')).capitalize()
+    if 'log_value' in values:
+        # minutes 1-59, hours 1-24, the probe unit when no format is given
+        unit = b'h' if settings.get('log_format') == 'Hours' else b'm'
+        settings['log_value'] = number('log_value', probe_bc_8340.STEP_FIELDS[probe_bc_8340.FRAME_CAL_LOG_VALUE][unit][0])
+    if 'run' in values:
+        settings['run'] = choice('run', ('start', 'stop')).upper()
+    if 'status' in values:
+        settings['status'] = choice('status', ('on', 'off')).upper()
+    return settings
+
+""" Apply several settings
+"""
+def apply_settings(id, settings):
+    logging.debug("Apply settings %s" % settings)
+    # weake probe
+    if client.probe_wakeup(id):
+        res = client.probe_configure(id, settings)
+        logging.info("Probe result: %s" % res)
+
+
 """ Data
     Functions to get data
 """
@@ -335,6 +416,14 @@ if __name__ == '__main__':
         # log
         logging.verbose("Configuration: %s" % conf)
 
+        # settings checked before the port is opened
+        if args['apply']:
+            try:
+                settings = parse_settings(args['<setting>'])
+            except ValueError as e:
+                logging.critical("Settings not applied: %s" % str(e))
+                sys.exit(1)
+
 
         """ Client
         """
@@ -420,6 +509,10 @@ if __name__ == '__main__':
                 id = args['--id'].zfill(2)
                 probe_switch_off(id)
 
+            elif args['apply']:
+                id = args['--id'].zfill(2)
+                apply_settings(id, settings)
+
             # data
             elif args['get_data']:
                 id = args['--id'].zfill(2)
@@ -456,6 +549,8 @@ if __name__ == '__main__':
 # probe_conf.py set_log_format hours
 # probe_conf.py set_log_value 1
 # probe_conf.py set_run start
+# or in one pass
+# probe_conf.py -b 2400 apply log_format=hours log_value=1 run=start date=gmt1 id=5 baud=9600
 
 """ data
 """
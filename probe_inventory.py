@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics probe network inventory
+#  File : probe_inventory.py
+# ----------------------------------------------------------------------
+""" Probe network inventory, one INI section per site
+
+    [DEFAULT]
+    port     = COM5
+    baud     = 9600
+    interval = 3600
+
+    [S20]
+    id      = 18
+    sensors = 3
+
+    An id is unique on its port only: download files, checkpoints and
+    records outputs are keyed by port and id.
+"""
+
+""" Imports
+"""
+import sys
+import logging
+import configparser
+
+if __name__ == '__main__':
+    sys.exit(1)
+
+
+# probe network - probes indexed by site, by port and id, and by port
+class Inventory:
+    """ Constants
+    """
+    INTERVAL = 3600  # polling interval (seconds) when not given
+
+    """ Init
+    """
+    def __init__(self, port, baud):
+        # defaults for probes not giving them
+        self.port = port
+        self.baud = int(baud)
+        # probes in file order
+        self.probes = []
+        # indexes
+        self.by_name = {}
+        self.by_address = {}
+        self.by_port = {}
+
+    """ Load inventory file, return True if probes were found
+    """
+    def load(self, file_name):
+        logging.debug("Function Inventory.load() - file: %s" % file_name)
+        try:
+            parser = configparser.ConfigParser()
+            if not parser.read(file_name):
+                logging.warning("Inventory %s not found" % file_name)
+                return False
+
+            for name in parser.sections():
+                section = dict(parser.items(name))
+                self.add({
+                    'name'     : name,
+                    'id'       : int(section['id']),
+                    'sensors'  : int(section['sensors']),
+                    'port'     : section.get('port') or self.port,
+                    'baud'     : int(section.get('baud') or self.baud),
+                    'interval' : int(section.get('interval') or self.INTERVAL),
+                })
+            logging.info("Inventory %s: %d probes on %d ports" % (file_name, len(self.probes), len(self.by_port)))
+            return len(self.probes) > 0
+
+        except Exception as e:
+            logging.critical("An exception was encountered in Inventory.load(): %s" % str(e))
+            return False
+
+    """ Add one probe, site and port/id must be unique
+    """
+    def add(self, probe):
+        address = (probe['port'], probe['id'])
+        if probe['name'] in self.by_name:
+            raise ValueError("duplicate site %s" % probe['name'])
+        if address in self.by_address:
+            raise ValueError("duplicate id %s on %s (%s, %s)" % (probe['id'], probe['port'], self.by_address[address]['name'], probe['name']))
+
+        self.probes.append(probe)
+        self.by_name[probe['name']] = probe
+        self.by_address[address] = probe
+        self.by_port.setdefault(probe['port'], []).append(probe)
+
+    """ Probe by site label, None if unknown
+    """
+    def get(self, name):
+        return self.by_name.get(name)
+
+    """ Probe by port and id, None if unknown
+    """
+    def find(self, port, id):
+        return self.by_address.get((port, int(id)))
+
+    """ Ports, in file order
+    """
+    def ports(self):
+        return list(self.by_port)
+
+    """ Probes on a port, in file order
+    """
+    def port_probes(self, port):
+        return self.by_port.get(port, [])
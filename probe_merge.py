@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# http://docopt.org/
+# sudo pip3 install docopt
+#
+"""probe_merge by ecometer snc.
+
+Usage:
+    probe_merge.py [-v ...] [options] [<id>...]
+    probe_merge.py (-h | --help)
+
+Arguments:
+    <id>            Probe ids to consolidate, all probes found when none.
+                    Download files data/SondaID-<id>_<port>_*.dat and the previous
+                    consolidated file are merged by record time, duplicates
+                    dropped (the newest download wins), into one ordered
+                    file per probe and port,
+                    SondaID-<id>_<port>.dat (SondaID-<id>.dat for download
+                    files without port)
+
+Options:
+    -h --help       Show this screen.
+    -v              Verbosity, more v, more verbose.
+    -o, --output=<d>  Consolidated files folder, in data [default: merged].
+    -r, --remove    Remove download files once merged.
+"""
+
+""" Imports
+"""
+import sys
+import os
+import logging
+import logging.handlers
+import glob
+import heapq
+import re
+from datetime import datetime
+from docopt import docopt
+
+
+""" Logging
+"""
+def createLog(level):
+    # path
+    logpath = os.path.join(os.path.dirname(os.path.realpath(__file__)),'log')
+    if not os.path.exists(logpath):
+        os.makedirs(logpath)
+
+    # logging custom level
+    logging.VERBOSE = 5  # positive yet important
+    logging.addLevelName(logging.VERBOSE, 'VERBOSE')      # new level
+    logging.getLogger('').setLevel(logging.INFO)
+    logging.Logger.verbose = lambda inst, msg, *args, **kwargs: inst.log(logging.VERBOSE, msg, *args, **kwargs)
+    logging.verbose = lambda msg, *args, **kwargs: logging.log(logging.VERBOSE, msg, *args, **kwargs)
+
+    # formatter
+    formatter = logging.Formatter('%(asctime)s-%(levelname)s: %(message)s')
+
+    # rotation
+    logfilename = os.path.join(logpath, 'probe_merge.log')
+    handler = logging.handlers.RotatingFileHandler(logfilename, maxBytes=1*1024*1024, backupCount=10)
+    handler.setFormatter(formatter)
+    logging.getLogger('').addHandler(handler)
+
+    # console
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    # formatter
+    formatter_console = logging.Formatter('%(asctime)s-%(levelname)s: %(message)s')
+    #formatter_console = logging.Formatter('%(message)s')
+    console.setFormatter(formatter_console)
+    logging.getLogger('').addHandler(console)
+
+    # set level
+    if level == 1:
+        logging.getLogger('').setLevel(logging.DEBUG)
+        console.setLevel(logging.DEBUG)
+    if level == 2:
+        logging.getLogger('').setLevel(logging.VERBOSE)
+        console.setLevel(logging.VERBOSE)
+
+    # https://docs.python.org/3.4/library/logging.handlers.html?highlight=backupcount
+    # CRITICAL 50
+    # ERROR    40
+    # WARNING  30
+    # INFO     20
+    # DEBUG    10
+    # VERBOSE   5
+    # NOTSET    0
+
+
+""" Records
+"""
+CR = b"\r"
+READ_SIZE = 64*1024  # bytes read at once, per file
+# SondaID-<id>_<port>_<time>.dat, no port in older files
+RE_DOWNLOAD = re.compile(r'SondaID-(\d+)_(?:(\w+)_)?\d{8}-\d{6}\.dat$')
+
+""" Records of a download file, (date time, record), in file order
+    records are id;date time;values separated by CR, read by chunks
+"""
+def read_records(file_name):
+    last = None
+    with open(file_name, 'rb') as the_file:
+        tail = b''
+        while True:
+            chunk = the_file.read(READ_SIZE)
+            lines = (tail + chunk).split(CR)
+            # last line may continue in the next chunk
+            tail = lines.pop() if chunk else b''
+            for line in lines:
+                line = line.strip()
+                fields = line.split(b';', 2)
+                if len(fields) < 3:
+                    continue
+                key = fields[1]
+                # the merge needs each file in time order
+                if last is not None and key < last:
+                    logging.warning("%s: record %s before %s, skipped" % (file_name, key.decode(), last.decode()))
+                    continue
+                last = key
+                yield key, line
+            if not chunk:
+                return
+
+
+""" Download files by probe id and port, {(id, port): [file, ...]} in name order
+    port '' for files without port
+"""
+def find_downloads(data_path, ids=None):
+    downloads = {}
+    for file_name in sorted(glob.glob(os.path.join(data_path, "SondaID-*_*.dat"))):
+        matches = RE_DOWNLOAD.search(file_name)
+        if not matches:
+            continue
+        id = matches.group(1)
+        if ids and id not in ids:
+            continue
+        # the same id may be used on several ports
+        downloads.setdefault((id, matches.group(2) or ''), []).append(file_name)
+    return downloads
+
+
+""" Records of a file tagged with its rank, (date time, rank, record)
+"""
+def ranked_records(file_name, rank):
+    for key, line in read_records(file_name):
+        yield key, rank, line
+
+
+""" Merge files into one ordered file without duplicates, return records written
+    file_names oldest first: of records with the same time, the one of the newest file is kept
+    open files only, memory does not depend on the records count
+"""
+def merge_files(file_names, output):
+    count = 0
+    last = None
+    temp = output + ".tmp"
+    with open(temp, 'wb') as out:
+        # same time: newest file first
+        for key, rank, line in heapq.merge(*[ranked_records(file_name, -k) for k, file_name in enumerate(file_names)]):
+            # same time downloaded twice, keep the newest
+            if key == last:
+                continue
+            if last is not None:
+                out.write(CR)
+            out.write(line)
+            last = key
+            count += 1
+        out.flush()
+        os.fsync(out.fileno())
+    # replace previous consolidated file only once complete
+    os.replace(temp, output)
+    return count
+
+
+""" Consolidate downloads of a probe on a port, return True on success
+"""
+def consolidate(data_path, output_path, id, port, file_names, remove):
+    output = os.path.join(output_path, "SondaID-"+id+("_"+port if port else "")+".dat")
+    # oldest first, download files are named by time
+    inputs = list(file_names)
+    if os.path.exists(output):
+        inputs.insert(0, output)
+    logging.info("Probe %s: merging %d files" % (id, len(inputs)))
+    try:
+        count = merge_files(inputs, output)
+        logging.info("Probe %s: %d records in %s" % (id, count, output))
+
+    except Exception as e:
+        logging.critical("An exception was encountered in consolidate(): %s" % str(e))
+        return False
+
+    if remove:
+        for file_name in file_names:
+            os.remove(file_name)
+            logging.verbose("Removed %s" % file_name)
+    return True
+
+
+""" Main script
+"""
+if __name__ == '__main__':
+
+    try:
+        """ Arguments
+        """
+        args = docopt(__doc__)
+
+        """ Logging
+        """
+        createLog(args['-v'])
+
+        """ Start
+        """
+        now = datetime.now()
+        logging.info("Starting program @ %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
+        logging.verbose("Arguments: %s" % args)
+
+        """ Path
+        """
+        # application path
+        app_path = os.path.dirname(os.path.realpath(__file__))
+        # data path
+        data_path = os.path.join(app_path, 'data')
+        output_path = os.path.join(data_path, args['--output'])
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+
+        """ Merge
+        """
+        ids = [id.zfill(2) for id in args['<id>']]
+        downloads = find_downloads(data_path, ids)
+        if not downloads:
+            logging.info("No download files to merge")
+        for id, port in sorted(downloads):
+            consolidate(data_path, output_path, id, port, downloads[(id, port)], args['--remove'])
+
+    # Handle invalid options
+    except Exception as e:
+        logging.critical("An exception was encountered: %s" % str(e))
+
+
+""" SAMPLES
+"""
+# probe_merge.py
+# probe_merge.py 18 24
+# probe_merge.py -r -o archive
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics protocol metrics
+#  File : probe_metrics.py
+# ----------------------------------------------------------------------
+""" Counters and round trip histograms by port, probe id and command letter,
+    fed by Client.serial_get_frame, shared by the clients of all ports.
+
+    commands, timeouts, bytes out and in, round trip (first command byte
+    sent to last answer byte) of answered commands; bcc errors by probe.
+    P commands are the record retransmits asked after a bcc error.
+
+    Written as Prometheus text, or JSON when the file name ends in .json.
+"""
+
+""" Imports
+"""
+import sys
+import os
+import json
+import logging
+import threading
+import time
+
+if __name__ == '__main__':
+    sys.exit(1)
+
+
+# command counters - one per port, probe id and command letter
+class CommandStats:
+    """ Init
+    """
+    def __init__(self, buckets):
+        self.count = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.rtt_sum = 0.0
+        self.rtt_max = 0.0
+        # answered commands by round trip bucket, not cumulative
+        self.buckets = [0] * (len(buckets) + 1)
+
+
+# protocol metrics - thread safe
+class Metrics:
+    """ Constants
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)  # round trip upper bounds (seconds)
+
+    """ Init
+    """
+    def __init__(self, file_name=None, buckets=BUCKETS):
+        # default file of write()
+        self.file_name = file_name
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # {(port, id, command): CommandStats}
+        self.commands = {}
+        # {(port, id): count}
+        self.bcc_errors = {}
+        self.started = time.time()
+
+    """ Account one command, <id><letter> as sent, frame received (bytes)
+    """
+    def command(self, port, command, rtt, frame, timed_out=False):
+        key = (str(port), command[:2], command[2:] or '?')
+        with self.lock:
+            stats = self.commands.get(key)
+            if stats is None:
+                stats = self.commands[key] = CommandStats(self.buckets)
+            stats.count += 1
+            # command and CR
+            stats.bytes_out += len(command) + 1
+            if timed_out:
+                stats.timeouts += 1
+                return
+            # frame and CRLF
+            stats.bytes_in += len(frame) + 2
+            stats.rtt_sum += rtt
+            stats.rtt_max = max(stats.rtt_max, rtt)
+            index = 0
+            while index < len(self.buckets) and rtt > self.buckets[index]:
+                index += 1
+            stats.buckets[index] += 1
+
+    """ Account one bcc error of a probe
+    """
+    def bcc_error(self, port, id):
+        key = (str(port), id)
+        with self.lock:
+            self.bcc_errors[key] = self.bcc_errors.get(key, 0) + 1
+
+    """ Metrics as a dict, JSON ready
+    """
+    def to_dict(self):
+        with self.lock:
+            commands = []
+            for (port, id, command), stats in sorted(self.commands.items()):
+                answered = stats.count - stats.timeouts
+                commands.append({
+                    'port'      : port,
+                    'probe'     : id,
+                    'command'   : command,
+                    'count'     : stats.count,
+                    'timeouts'  : stats.timeouts,
+                    'bytes_out' : stats.bytes_out,
+                    'bytes_in'  : stats.bytes_in,
+                    'rtt_avg'   : stats.rtt_sum / answered if answered else None,
+                    'rtt_max'   : stats.rtt_max if answered else None,
+                    'rtt_buckets' : dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], stats.buckets)),
+                })
+            probes = [{'port': port, 'probe': id, 'bcc_errors': count} for (port, id), count in sorted(self.bcc_errors.items())]
+        return {'started': self.started, 'time': time.time(), 'commands': commands, 'probes': probes}
+
+    """ Metrics in Prometheus text format
+    """
+    def to_prometheus(self):
+        def labels(port, id, command=None, le=None):
+            items = [('port', port), ('probe', id)]
+            if command is not None:
+                items.append(('command', command))
+            if le is not None:
+                items.append(('le', le))
+            return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in items)
+
+        lines = []
+        with self.lock:
+            commands = sorted(self.commands.items())
+            for name, help, attr in (('probe_commands_total', 'Commands sent', 'count'),
+                                     ('probe_timeouts_total', 'Commands without answer', 'timeouts'),
+                                     ('probe_bytes_out_total', 'Bytes sent', 'bytes_out'),
+                                     ('probe_bytes_in_total', 'Bytes received in answers', 'bytes_in')):
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s counter' % name)
+                for (port, id, command), stats in commands:
+                    lines.append('%s%s %d' % (name, labels(port, id, command), getattr(stats, attr)))
+
+            lines.append('# HELP probe_rtt_seconds Round trip of answered commands')
+            lines.append('# TYPE probe_rtt_seconds histogram')
+            for (port, id, command), stats in commands:
+                cumulative = 0
+                for bound, count in zip([repr(bound) for bound in self.buckets] + ['+Inf'], stats.buckets):
+                    cumulative += count
+                    lines.append('probe_rtt_seconds_bucket%s %d' % (labels(port, id, command, bound), cumulative))
+                lines.append('probe_rtt_seconds_sum%s %.6f' % (labels(port, id, command), stats.rtt_sum))
+                lines.append('probe_rtt_seconds_count%s %d' % (labels(port, id, command), cumulative))
+
+            lines.append('# HELP probe_bcc_errors_total Records received with a wrong bcc')
+            lines.append('# TYPE probe_bcc_errors_total counter')
+            for (port, id), count in sorted(self.bcc_errors.items()):
+                lines.append('probe_bcc_errors_total%s %d' % (labels(port, id), count))
+        return '\n'.join(lines) + '\n'
+
+    """ Write metrics file, replaced at once, return True on success
+    """
+    def write(self, file_name=None):
+        file_name = file_name or self.file_name
+        try:
+            if file_name.endswith('.json'):
+                data = json.dumps(self.to_dict(), indent=1, sort_keys=True)
+            else:
+                data = self.to_prometheus()
+            temp = file_name + ".tmp"
+            with self.lock:
+                with open(temp, 'w') as the_file:
+                    the_file.write(data)
+                os.replace(temp, file_name)
+            logging.verbose("Metrics written to %s" % file_name)
+            return True
+
+        except Exception as e:
+            logging.critical("An exception was encountered in Metrics.write(): %s" % str(e))
+            return False
@@ -13,13 +13,16 @@
 Usage:
     probe_net.py [-v ...] [options] get_data <sensors> (last|all)
     probe_net.py [-v ...] [options] get_net_data
+    probe_net.py [-v ...] [options] daemon
     probe_net.py (-h | --help)
 
 Arguments:
     get_data        Get probe data
                     # <sensors> number of sensors 3|5
                     # (last|all) download last data or all data
-    get_net_data    Get all network probes data
+    get_net_data    Get all inventory probes data, one worker per serial port
+    daemon          Keep serial ports open, download each inventory probe
+                    right after it logs, at its LOG ON TIME interval
 
 Options:
     -h --help       Show this screen.
@@ -27,6 +30,14 @@ Options:
     -i, --id=<n>    Probe id [default: 0].
     -p, --port=<s>  Port [default: COM5].
     -b, --baud=<n>  Baudrate [default: 9600].
+    -n, --inventory=<f>  Probe network inventory [default: probe_net.ini].
+    -s, --sink=<s>  Records ingestion, perl script on .dat files or in process
+                    backend csv|null|sqlite|columns [default: perl].
+    -t, --trace=<n>  Last raw frames kept by port, dumped to data on timeout
+                    or errors, 0 disables [default: 2000].
+    -m, --metrics=<f>  Commands metrics file in data, written after each run
+                    or daemon download, JSON when .json, Prometheus text
+                    otherwise [default: probe_metrics.prom].
 """
 
 """ Imports
@@ -39,10 +50,16 @@ import time
 import re
 import serial
 import subprocess
+import threading
+import heapq
+import signal
 from datetime import datetime, timedelta
 from docopt import docopt
 # ecometer modules
 import probe_bc_8340
+import probe_inventory
+import probe_sink
+import probe_metrics
 
 
 """ Logging
@@ -107,6 +124,35 @@ def clearscreen(numlines=100):
         os.system('CLS')
 
 
+""" External import
+"""
+IMPORT_COMMAND = ["perl", "c:/SmartDMS/Sonde_BC8340/probe_import.pl"]
+import_lock = threading.Lock()
+import_pipe = None
+
+""" Daemon timing (seconds)
+"""
+DAEMON_MARGIN  = 30        # after the probe logs, before downloading
+DAEMON_REFRESH = 24*3600   # LOG ON TIME and probe clock read again
+DAEMON_RETRY   = 60        # serial port open retry
+
+
+""" Execute external perl script, unless still running
+"""
+def run_import():
+    global import_pipe
+    with import_lock:
+        if import_pipe is not None and import_pipe.poll() is None:
+            logging.info("External perl script still running")
+            return
+        try:
+            logging.info("Executing external perl script...")
+            import_pipe = subprocess.Popen(IMPORT_COMMAND, stdout=open(os.devnull, 'w'))
+
+        except Exception as e:
+            logging.critical("An exception was encountered in run_import(): %s" % str(e))
+
+
 """ Data
     Functions to get data
 """
@@ -117,6 +163,172 @@ def get_data(id, sensors, all):
         res = client.probe_download_data(id, sensors, all)
         logging.info("Probe result: %s" % res)
 
+""" Poll probes on one bus, own client and port
+"""
+def poll_port(conf, data_path, probes, results, lock, sink, metrics):
+    logging.info("Polling port %s, probes %s" % (conf['port'], ', '.join(probe['name'] for probe in probes)))
+    port_client = probe_bc_8340.Client(conf, data_path)
+    port_client.sink = sink
+    port_client.metrics = metrics
+    try:
+        if not port_client.serial_open():
+            logging.warning("Impossible to open serial port %s" % conf['port'])
+            port_results = dict((probe['name'], None) for probe in probes)
+        else:
+            port_results = {}
+            for probe in probes:
+                id = str(probe['id']).zfill(2)
+                # probes on a bus may talk at different speeds
+                if probe['baud'] != int(port_client.ser.baudrate):
+                    port_client.serial_set_baudrate(probe['baud'])
+                res = None
+                # weake probe
+                if port_client.probe_wakeup(id):
+                    res = port_client.probe_download_data(id, probe['sensors'], False)
+                logging.info("Probe %s result: %s" % (probe['name'], res))
+                port_results[probe['name']] = res
+
+        # merge
+        with lock:
+            results.update(port_results)
+
+    except Exception as e:
+        logging.critical("An exception was encountered in poll_port(): %s" % str(e))
+
+    # clean up, closes the port
+    del port_client
+
+""" Get last data of all inventory probes, buses polled concurrently
+"""
+def get_net_data(conf, data_path, inventory, sink=None, metrics=None):
+    ports = inventory.ports()
+    results = {}
+    lock = threading.Lock()
+    workers = []
+    start = time.time()
+    for port in ports:
+        probes = inventory.port_probes(port)
+        port_conf = dict(conf, port=port, baudrate=probes[0]['baud'])
+        worker = threading.Thread(target=poll_port, name=port, args=(port_conf, data_path, probes, results, lock, sink, metrics))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+    logging.info("Network polled in %.1fs, %d ports: %s" % (time.time() - start, len(ports), results))
+    return results
+
+
+
+
+""" Probe log interval (seconds) from LOG ON TIME, inventory interval if unknown
+"""
+def probe_interval(port_client, id, probe):
+    snapshot = port_client.snapshots.get(id)
+    if snapshot is None or snapshot.log_value is None:
+        return probe['interval']
+    return snapshot.log_value * (3600 if snapshot.log_unit == 'h' else 60)
+
+""" Next download time (local clock), DAEMON_MARGIN after the probe logs its next record
+"""
+def next_download(port_client, id, interval, now):
+    last = port_client.last_records.get(id)
+    snapshot = port_client.snapshots.get(id)
+    if last is None or snapshot is None or snapshot.time is None:
+        return now + interval
+
+    # probe clock offset, read with the configuration
+    offset = snapshot.time - datetime.fromtimestamp(snapshot.taken)
+    record = datetime.strptime(last, '%Y-%m-%d %H:%M:%S') - offset
+    due = time.mktime(record.timetuple()) + interval + DAEMON_MARGIN
+    if due <= now:
+        # slots missed or logging stopped, keep the probe phase
+        due += (int((now - due) // interval) + 1) * interval
+    return due
+
+""" Daemon worker: keep the port open, download each probe when due
+"""
+def serve_port(conf, data_path, probes, stop, sink, metrics):
+    logging.info("Serving port %s, probes %s" % (conf['port'], ', '.join(probe['name'] for probe in probes)))
+    port_client = probe_bc_8340.Client(conf, data_path)
+    port_client.sink = sink
+    port_client.metrics = metrics
+    while not port_client.serial_open():
+        logging.warning("Impossible to open serial port %s, retry in %ss" % (conf['port'], DAEMON_RETRY))
+        if stop.wait(DAEMON_RETRY):
+            return
+
+    # (due time, inventory order, probe), all due now
+    now = time.time()
+    schedule = [(now, n, probe) for n, probe in enumerate(probes)]
+    heapq.heapify(schedule)
+    while not stop.is_set():
+        due, n, probe = schedule[0]
+        if stop.wait(max(0, due - time.time())):
+            break
+        heapq.heappop(schedule)
+
+        try:
+            id = str(probe['id']).zfill(2)
+            # probes on a bus may talk at different speeds
+            if probe['baud'] != int(port_client.ser.baudrate):
+                port_client.serial_set_baudrate(probe['baud'])
+
+            res = None
+            # weake probe
+            if port_client.probe_wakeup(id):
+                res = port_client.probe_download_data(id, probe['sensors'], False)
+                # log interval and probe clock, once a day
+                snapshot = port_client.snapshots.get(id)
+                if snapshot is None or snapshot.age() > DAEMON_REFRESH:
+                    port_client.get_probe_snapshot(id, refresh=True)
+            logging.info("Probe %s result: %s" % (probe['name'], res))
+            if res and sink is None:
+                run_import()
+            port_client.save_response_timers()
+            if metrics is not None:
+                metrics.write()
+
+        except Exception as e:
+            logging.critical("An exception was encountered in serve_port(): %s" % str(e))
+
+        interval = probe_interval(port_client, id, probe)
+        due = next_download(port_client, id, interval, time.time())
+        logging.info("Probe %s next download @ %s" % (probe['name'], datetime.fromtimestamp(due).strftime("%Y-%m-%d %H:%M:%S")))
+        heapq.heappush(schedule, (due, n, probe))
+
+    # clean up, closes the port
+    del port_client
+
+""" Run daemon until interrupted, one worker per port
+"""
+def serve(conf, data_path, inventory, sink=None, metrics=None):
+    stop = threading.Event()
+    # stop on kill as on ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    workers = []
+    for port in inventory.ports():
+        probes = inventory.port_probes(port)
+        port_conf = dict(conf, port=port, baudrate=probes[0]['baud'])
+        worker = threading.Thread(target=serve_port, name=port, args=(port_conf, data_path, probes, stop, sink, metrics))
+        worker.start()
+        workers.append(worker)
+
+    try:
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
+            if stop.is_set():
+                break
+    except KeyboardInterrupt:
+        logging.info("Stopping...")
+        stop.set()
+
+    for worker in workers:
+        worker.join()
+    logging.info("Daemon stopped")
+
 
 
 
@@ -124,6 +336,8 @@ def get_data(id, sensors, all):
 """
 if __name__ == '__main__':
 
+    sink = None
+    metrics = None
     try:
         """ Arguments
         """
@@ -167,60 +381,71 @@ if __name__ == '__main__':
             conf['port'] = args['--port']
         if args['--baud']:
             conf['baudrate'] = args['--baud']
+        conf['trace'] = int(args['--trace'])
 
         # log
         logging.verbose("Configuration: %s" % conf)
 
 
-        """ Client
+        """ Arguments
         """
-        client = probe_bc_8340.Client(conf, data_path)
-        if not client.serial_open():
-            # log
-            logging.info("Impossible to open serail port!")
-        else:
+        logging.debug("Parse args")
+        client = None
+        if args['--sink'] != 'perl':
+            # records ingested in process, as they are downloaded
+            sink = probe_sink.create_sink(args['--sink'], data_path)
+        metrics = probe_metrics.Metrics(os.path.join(data_path, args['--metrics']))
+
+        if args['get_net_data']:
+            # probe network, relative to the application path
+            inventory = probe_inventory.Inventory(conf['port'], conf['baudrate'])
+            if inventory.load(os.path.join(app_path, args['--inventory'])):
+                # one client per port, opened by the workers
+                get_net_data(conf, data_path, inventory, sink, metrics)
+
+            if sink is None:
+                # execute external perl script
+                run_import()
+
+        elif args['daemon']:
+            # probe network, relative to the application path
+            inventory = probe_inventory.Inventory(conf['port'], conf['baudrate'])
+            if inventory.load(os.path.join(app_path, args['--inventory'])):
+                serve(conf, data_path, inventory, sink, metrics)
 
-            """ Arguments
+        else:
+            """ Client
             """
-            logging.debug("Parse args")
-            if args['get_data']:
+            client = probe_bc_8340.Client(conf, data_path)
+            if not client.serial_open():
+                # log
+                logging.info("Impossible to open serail port!")
+            elif args['get_data']:
+                client.sink = sink
+                client.metrics = metrics
                 id = args['--id'].zfill(2)
                 sensors =  args['<sensors>']
                 last =  args['last']
                 all =  args['all']
                 get_data(id, sensors, all)
 
-            elif args['get_net_data']:
-                # get sensor last data
-                # -- S20 -> ID18 {3} > OK
-                get_data(str(18).zfill(2), 3, False)
-
-                # -- S26 -> ID24 {5} > OK
-                get_data(str(24).zfill(2), 5, False)
-
-                # -- S26bis -> ID25 {5} > OK
-                get_data(str(25).zfill(2), 5, False)
-
-                # -- S08 -> ID5 {3}
-                #get_data(5, 3, False)
-
-                # -- S13 -> ID10 {5}
-                #get_data(10, 5, False)
-
-                # execute external perl script
-                logging.info("Executing external perl script...")
-                pipe = subprocess.Popen(["perl", "c:/SmartDMS/Sonde_BC8340/probe_import.pl"], stdout=subprocess.PIPE)
-
     # Handle invalid options
     except Exception as e:
         logging.critical("An exception was encountered: %s" % str(e))
 
     # clean up
-    del client
+    client = None
+    if sink is not None:
+        sink.close()
+    if metrics is not None:
+        metrics.write()
 
 
 """ SAMPLES
 """
 # probe_net.py get_data 3 last
 # probe_net.py get_data 5 last
-# probe_net.py get_net_data
\ No newline at end of file
+# probe_net.py get_net_data
+# probe_net.py -n site.ini get_net_data
+# probe_net.py -n site.ini daemon
+# probe_net.py -s csv daemon
\ No newline at end of file
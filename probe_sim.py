@@ -0,0 +1,529 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# http://docopt.org/
+# sudo pip3 install docopt
+#
+"""probe_sim by ecometer snc.
+
+Usage:
+    probe_sim.py [-v ...] [options] <id>...
+    probe_sim.py (-h | --help)
+
+Arguments:
+    <id>            Ids of the virtual probes on the bus
+
+Options:
+    -h --help       Show this screen.
+    -v              Verbosity, more v, more verbose.
+    -p, --port=<s>  Serve on a serial port, one end of a null modem pair
+                    (com0com, socat), instead of a new pty.
+    -b, --baud=<n>  Line speed of --port [default: 9600].
+    -s, --sensors=<n>     Probe sensors 3|5 [default: 5].
+    -r, --records=<n>     Records in probe memory [default: 100].
+    -i, --interval=<s>    Probe LOG ON TIME, seconds [default: 3600].
+    -t, --turnaround=<s>  Delay before each answer, seconds [default: 0.05].
+    -c, --corruption=<p>  Probability of a corrupted answer [default: 0].
+    -l, --loss=<p>        Probability of a command not heard [default: 0].
+"""
+
+""" Virtual SA8340 probes answering the bc-electronics protocol, for tests
+    and benchmarks of probe_bc_8340.Client without probes on a bench.
+
+    bus = PtyBus([VirtualProbe(18, sensors=3), VirtualProbe(24)])
+    conf['port'] = bus.port   # client runs unchanged on the pty
+
+    Probes keep record memory (up to MEMORY), menu and calibration state,
+    clock, log interval, power and baud rate. A running probe logs new
+    records as its clock goes. A bus answers at the line speed; a probe
+    set to another baud rate does not answer.
+"""
+
+""" Imports
+"""
+import sys
+import os
+import logging
+import threading
+import time
+import random
+import select
+from datetime import datetime, timedelta
+# ecometer modules
+from probe_bc_8340 import get_bcc
+
+
+#- ----------------------------------------------------------------------------
+#- probe
+#- ----------------------------------------------------------------------------
+BAUDS  = (1200, 2400, 4800, 9600, 19200)
+MEMORY = 1360  # records kept by a probe, oldest dropped
+
+# virtual probe - answers commands, id and line end stripped
+class VirtualProbe:
+    """ Constants
+    """
+    FIRMWARE = '5.1'
+    RELEASE  = 'R2.63'
+    LINE_PAD = 43  # menu lines are space padded before the bcc
+    UNITS    = ('m', '\xf8C', 'mS', 'pH', 'mV')
+    FORMATS  = ('%.3f', '%.2f', '%.3f', '%.3f', '%.1f')
+    # menu items, redox only on 5 sensors probes
+    MENU = ('log', 'rec', 'battery_check', 'battery', 'time', 'level', 'temp', 'cond', 'ph', 'redox',
+            'rt_cont', 'timeout', 'power', 'id', 'baud')
+    CALIBRATION = {'log': 3, 'time': 5, 'id': 1, 'baud': 1}  # items with C, steps
+    # calibration time steps: label, attribute, min, max, U/D wrap around
+    TIME_FIELDS = (('DAY', 'day', 1, 31), ('MON.', 'month', 1, 12), ('YEAR', 'year', 0, 99),
+                   ('HOUR', 'hour', 0, 23), ('MIN.', 'minute', 0, 59))
+
+    """ Init
+    """
+    def __init__(self, id, sensors=5, records=100, interval=3600, start=None, baud=9600):
+        self.id = int(id)
+        self.sensors = 5 if int(sensors) == 5 else 3
+        # 3 sensors probes send an extra value column
+        self.columns = 5 if self.sensors == 5 else 4
+        self.menu = [item for item in self.MENU if item != 'redox' or self.sensors == 5]
+        # configuration
+        self.unit = 'h' if interval >= 3600 and interval % 3600 == 0 else 'm'
+        self.log_value = interval // 3600 if self.unit == 'h' else max(1, interval // 60)
+        self.run = 'START'
+        self.power = 'ON'
+        self.baud = baud
+        # probe clock, offset from the host clock
+        self.offset = timedelta(0)
+        # record memory, last records logged up to now by default
+        records = min(int(records), MEMORY)
+        if start is None:
+            start = self.now().replace(second=0, microsecond=0) - timedelta(seconds=self.interval() * records)
+        self.records = [(start + timedelta(seconds=self.interval() * k), self.values(k)) for k in range(records)]
+        self.logged = len(self.records)
+        # next record downloaded by L
+        self.pointer = 0
+        # command state: idle, menu, cal, transfer, armed, download
+        self.state = 'idle'
+        self.item = 0
+        self.step_index = 0
+        self.new_id = self.id
+        self.new_baud = self.baud
+        self.mode = None
+        self.download = []
+        self.download_pos = 0
+        self.last = ''
+
+    """ Log interval, seconds
+    """
+    def interval(self):
+        return self.log_value * (3600 if self.unit == 'h' else 60)
+
+    """ Probe clock
+    """
+    def now(self):
+        return datetime.now() + self.offset
+
+    """ Values of the k-th record, slowly changing
+    """
+    def values(self, k):
+        values = (0.002 * (k % 3), 20 + (k % 50) / 10.0, -0.001, 6.5 + (k % 10) / 100.0, 400 + k % 30)
+        return values[:self.columns]
+
+    """ Log records due by the probe clock, while running
+    """
+    def __log(self):
+        if self.run != 'START' or self.power != 'ON' or not self.records:
+            return
+        now = self.now()
+        due = self.records[-1][0] + timedelta(seconds=self.interval())
+        if due > now:
+            return
+        # clock set far ahead, a full memory at most
+        missed = int((now - due).total_seconds() // self.interval())
+        if missed >= MEMORY:
+            due += timedelta(seconds=self.interval() * (missed - MEMORY + 1))
+        while due <= now:
+            self.records.append((due, self.values(self.logged)))
+            self.logged += 1
+            due += timedelta(seconds=self.interval())
+        dropped = len(self.records) - MEMORY
+        if dropped > 0:
+            del self.records[:dropped]
+            self.pointer = max(0, self.pointer - dropped)
+
+    """ Probe line, SA8340- <id> <body> bcc
+    """
+    def line(self, body, pad=LINE_PAD):
+        body = ('SA8340- %02d ' % self.id) + body
+        if pad:
+            body = body.ljust(pad)[:pad]
+        data = body.encode('latin1')
+        return data + get_bcc(data)
+
+    """ Record line, values in 12 chars columns
+    """
+    def record(self, date_time, values):
+        body = '%s %s' % (self.FIRMWARE, date_time.strftime('%d/%m/%y %H:%M:%S'))
+        body += ''.join(((self.FORMATS[k] % value).rjust(8) + self.UNITS[k]).ljust(12) for k, value in enumerate(values))
+        first = self.records[0][0] if self.records else date_time
+        return self.line(body + ' ' + first.strftime('%d/%m/%y'), pad=0)
+
+    """ Menu item line
+    """
+    def item_line(self, item):
+        now = self.now()
+        lines = {
+            'log'           : 'LOG ON TIME %2d%s %s' % (self.log_value, self.unit, self.run),
+            'rec'           : 'REC INST.  1354 REC UTIL. %5d' % len(self.records),
+            'battery_check' : 'MAIN  B.    V',
+            'battery'       : 'MAIN  B. 5.1V OK',
+            'time'          : 'TIME  %s        %s' % (now.strftime('%d/%m/%y'), now.strftime('%H:%M:%S')),
+            'level'         : 'LEVEL  0.007m',
+            'temp'          : 'TEMP.  25.90\xf8C',
+            'cond'          : 'COND. -0.001mS  T.REF:20 TC:2.10',
+            'ph'            : 'pH     8.714pH  A:-0.22pH S: 98%',
+            'redox'         : 'REDOX-  41.0mV  A:   16mV S:100%',
+            'rt_cont'       : 'RT CONT.:   10 s',
+            'timeout'       : 'TIMEOUT ON STARTPROFILE: 10m',
+            'power'         : '    POWER %s' % self.power,
+            'id'            : 'SA8340 %s    ID: %02d' % (self.RELEASE, self.id),
+            'baud'          : 'TRANSMISSION    BAUD RATE:  %d' % self.baud,
+        }
+        return self.line(lines[item])
+
+    """ Calibration line of the current item and step
+    """
+    def cal_line(self):
+        item = self.menu[self.item]
+        if item == 'log':
+            if self.step_index == 0:
+                return self.line('CAL LOG:        ON TIME')
+            if self.step_index == 1:
+                return self.line('CAL LOG: T.INT   %s' % ('Hours' if self.unit == 'h' else 'Minutes'))
+            return self.line('CAL LOG: T.INT   %2d%s' % (self.log_value, self.unit))
+        if item == 'time':
+            label, attr, low, high = self.TIME_FIELDS[self.step_index]
+            return self.line('CAL TIME  %-5s %02d' % (label, getattr(self.now(), attr) % 100))
+        if item == 'id':
+            return self.line('SA8340 %s    CAL ID: %02d' % (self.RELEASE, self.new_id))
+        return self.line('CAL TRANSMISSIONBAUD RATE:  %d' % self.new_baud)
+
+    """ Calibration U (+1) or D (-1) on the current item and step
+    """
+    def __step(self, delta):
+        item = self.menu[self.item]
+        if item == 'log':
+            if self.step_index == 1:
+                self.unit = 'h' if delta > 0 else 'm'
+                self.log_value = min(self.log_value, 24 if self.unit == 'h' else 59)
+            elif self.step_index == 2:
+                self.log_value = min(24 if self.unit == 'h' else 59, max(1, self.log_value + delta))
+        elif item == 'time':
+            label, attr, low, high = self.TIME_FIELDS[self.step_index]
+            now = self.now()
+            value = getattr(now, attr) % 100 + delta
+            if value > high:
+                value = low
+            elif value < low:
+                value = high
+            try:
+                now = now.replace(**{attr: 2000 + value if attr == 'year' else value})
+                self.offset = now - datetime.now()
+            except ValueError:
+                # day not in month, unchanged
+                pass
+        elif item == 'id':
+            self.new_id = min(99, max(0, self.new_id + delta))
+        elif item == 'baud':
+            index = BAUDS.index(self.new_baud)
+            self.new_baud = BAUDS[min(len(BAUDS) - 1, max(0, index + delta))]
+
+    """ Answer one command, None when the probe does not answer
+    """
+    def handle(self, command):
+        self.__log()
+
+        # transfer: T, N count, G|L then I, N records, P again, Z pointer reset
+        if self.state == 'download' and command in ('N', 'P'):
+            if command == 'P':
+                return self.last
+            if self.download_pos >= len(self.download):
+                self.state = 'transfer'
+                return b'STOP'
+            date_time, values = self.download[self.download_pos]
+            self.download_pos += 1
+            self.last = self.record(date_time, values)
+            return self.last
+        if self.state in ('transfer', 'download'):
+            if command == 'N':
+                return b'  %d' % len(self.records)
+            if command in ('G', 'L'):
+                self.mode = command
+                self.download = self.records if command == 'G' else self.records[self.pointer:]
+                self.download_pos = 0
+                self.state = 'armed'
+                return command.encode()
+            if command == 'Z':
+                self.pointer = len(self.records)
+                return b'Z'
+        if self.state == 'armed' and command == 'I':
+            self.state = 'download'
+            return b'I'
+
+        if command == 'T':
+            self.state = 'transfer'
+            return b'READY'
+        if command == 'A':
+            # last measure, as a record at the probe time
+            self.state = 'idle'
+            return self.record(self.now().replace(microsecond=0), self.values(self.logged))
+        if command == 'E':
+            self.state = 'menu'
+            self.item = 0
+            return self.item_line(self.menu[0])
+        if command == 'O':
+            self.state = 'idle'
+            return b'O'
+
+        if self.state == 'menu':
+            item = self.menu[self.item]
+            if command == 'M':
+                self.item = (self.item + 1) % len(self.menu)
+                return self.item_line(self.menu[self.item])
+            if command == 'C' and item in self.CALIBRATION:
+                self.state = 'cal'
+                self.step_index = 0
+                self.new_id = self.id
+                self.new_baud = self.baud
+                return self.cal_line()
+            if command in ('U', 'D') and item == 'log':
+                self.run = 'START' if command == 'U' else 'STOP'
+                return self.item_line(item)
+            if command in ('U', 'D') and item == 'power':
+                self.power = 'ON' if command == 'U' else 'OFF'
+                return self.item_line(item)
+            if command == 'I':
+                if item == 'power' and self.power == 'OFF':
+                    return self.line('    POWER OFF       **WAIT**')
+                return self.item_line(item)
+
+        if self.state == 'cal':
+            item = self.menu[self.item]
+            if command in ('U', 'D'):
+                self.__step(1 if command == 'U' else -1)
+                return self.cal_line()
+            if command == 'I':
+                # next step, the last one confirms and stores
+                if self.step_index < self.CALIBRATION[item] - 1:
+                    self.step_index += 1
+                    return self.cal_line()
+                self.state = 'menu'
+                if item == 'id':
+                    self.id = self.new_id
+                response = self.item_line(item)
+                # line speed changes after this answer
+                self.baud = self.new_baud
+                return response
+
+        return None
+
+
+#- ----------------------------------------------------------------------------
+#- buses
+#- ----------------------------------------------------------------------------
+# probes on one line - commands <id><command>CR, answers <line>CRLF
+class Bus:
+    """ Init
+        turnaround: seconds before answering, byte_time: seconds per byte,
+        10 bits at the line speed when None, corruption: probability of one
+        flipped bit in an answer, loss: probability of a command not heard
+    """
+    def __init__(self, probes, turnaround=0.0, byte_time=None, corruption=0.0, loss=0.0):
+        self.probes = dict((probe.id, probe) for probe in probes)
+        self.turnaround = turnaround
+        self.byte_time = byte_time
+        self.corruption = corruption
+        self.loss = loss
+        self.commands = 0
+        self.lost = 0
+        self.running = False
+        self.thread = None
+
+    """ Serve commands in a daemon thread
+    """
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name='bus')
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Stop serving
+    """
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    """ Answer bytes, as sent on the line
+    """
+    def answer(self, command, baud):
+        try:
+            id = int(command[:2])
+        except ValueError:
+            return None
+        probe = self.probes.get(id)
+        if probe is None or probe.baud != baud:
+            return None
+        if self.loss and random.random() < self.loss:
+            self.lost += 1
+            return None
+        response = probe.handle(command[2:].decode('latin1'))
+        if response is None:
+            return None
+        if probe.id != id:
+            # new id from the calibration
+            self.probes[probe.id] = self.probes.pop(id)
+        if self.corruption and len(response) > 20 and random.random() < self.corruption:
+            k = random.randrange(12, len(response) - 2)
+            response = response[:k] + bytes((response[k] ^ 0x01,)) + response[k+1:]
+        return response + b'\r\n'
+
+    """ Read commands and answer until stopped
+    """
+    def serve(self):
+        buffer_data = b''
+        while self.running:
+            try:
+                data = self.receive(0.2)
+            except (OSError, IOError):
+                return
+            if not data:
+                continue
+            buffer_data += data
+            while b'\r' in buffer_data:
+                command, buffer_data = buffer_data.split(b'\r', 1)
+                if len(command) < 3:
+                    continue
+                self.commands += 1
+                baud = self.line_baud()
+                response = self.answer(command, baud)
+                if response is None:
+                    logging.debug("Bus %s: no answer" % command)
+                    continue
+                if self.turnaround:
+                    time.sleep(self.turnaround)
+                byte_time = self.byte_time if self.byte_time is not None else 10.0 / baud
+                if byte_time:
+                    time.sleep(byte_time * len(response))
+                self.send(response)
+
+
+# bus on a new pty, clients open port
+class PtyBus(Bus):
+    """ Init, serving at once
+    """
+    def __init__(self, probes, **kwargs):
+        import pty
+        import tty
+        import termios
+        Bus.__init__(self, probes, **kwargs)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        # line speed set by the client on the pty
+        self.termios = termios
+        self.speeds = dict((getattr(termios, 'B%d' % baud), baud) for baud in BAUDS)
+        self.start()
+
+    """ Bytes received, empty after timeout
+    """
+    def receive(self, timeout):
+        readable, _, _ = select.select([self.master], [], [], timeout)
+        if not readable:
+            return b''
+        return os.read(self.master, 1024)
+
+    """ Send bytes
+    """
+    def send(self, data):
+        os.write(self.master, data)
+
+    """ Line speed set by the client
+    """
+    def line_baud(self):
+        return self.speeds.get(self.termios.tcgetattr(self.slave)[5], 9600)
+
+    """ Stop and close pty
+    """
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+# bus on a serial port, clients open the other end of a null modem pair
+class SerialBus(Bus):
+    """ Init, serving at once
+    """
+    def __init__(self, probes, port, baud=9600, **kwargs):
+        import serial
+        Bus.__init__(self, probes, **kwargs)
+        self.port = port
+        self.ser = serial.Serial(port=port, baudrate=int(baud), timeout=0.2)
+        self.start()
+
+    """ Bytes received, empty after timeout
+    """
+    def receive(self, timeout):
+        data = self.ser.read(1)
+        if data and self.ser.in_waiting:
+            data += self.ser.read(self.ser.in_waiting)
+        return data
+
+    """ Send bytes
+    """
+    def send(self, data):
+        self.ser.write(data)
+
+    """ Line speed of the port
+    """
+    def line_baud(self):
+        return self.ser.baudrate
+
+    """ Stop and close port
+    """
+    def close(self):
+        self.stop()
+        self.ser.close()
+
+
+""" Main script
+"""
+if __name__ == '__main__':
+
+    from docopt import docopt
+    args = docopt(__doc__)
+    logging.basicConfig(level=logging.DEBUG if args['-v'] else logging.INFO, format='%(asctime)s-%(levelname)s: %(message)s')
+
+    probes = [VirtualProbe(id, sensors=int(args['--sensors']), records=int(args['--records']), interval=int(args['--interval']),
+                           baud=int(args['--baud'])) for id in args['<id>']]
+    options = {'turnaround': float(args['--turnaround']), 'corruption': float(args['--corruption']), 'loss': float(args['--loss'])}
+    if args['--port']:
+        bus = SerialBus(probes, args['--port'], args['--baud'], **options)
+    else:
+        bus = PtyBus(probes, **options)
+    logging.info("Probes %s on %s" % (', '.join('%02d' % probe.id for probe in probes), bus.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    bus.close()
+    logging.info("%d commands served" % bus.commands)
+
+
+""" SAMPLES
+"""
+# probe_sim.py 18 24
+# probe_net.py -p /dev/pts/3 -i 18 get_data 5 all
+# probe_sim.py -s 3 -r 1360 -i 60 -c 0.01 05
+# probe_sim.py -p COM11 -b 2400 05
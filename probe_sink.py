@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics records ingestion, in process
+#  File : probe_sink.py
+# ----------------------------------------------------------------------
+""" Validated records of a completed download are handed to a RecordSink by
+    the download pipeline and written by a backend at once, one transaction
+    per download: the probe pointer is reset only once its records are
+    committed, a sink write never waits for other downloads.
+
+    Backend: object with write(records) and close(), records as
+    (port, probe id, 'YYYY-MM-DD HH:MM:SS', (value, ...)) tuples, written
+    in one transaction. Port as tagged in the download file names, the same
+    probe id may be used on several ports.
+"""
+
+""" Imports
+"""
+import sys
+import os
+import logging
+import threading
+import time
+# ecometer modules
+import probe_store
+import probe_columns
+
+if __name__ == '__main__':
+    sys.exit(1)
+
+
+#- ----------------------------------------------------------------------------
+#- backends
+#- ----------------------------------------------------------------------------
+# csv backend - one file per day, port;probe id;date time;values
+class CsvBackend:
+    """ Init
+    """
+    def __init__(self, data_path):
+        self.data_path = data_path
+
+    """ Append records to the file of the day
+    """
+    def write(self, records):
+        file_name = os.path.join(self.data_path, "records-"+time.strftime('%Y%m%d')+".csv")
+        with open(file_name, 'a') as the_file:
+            for port, probe_id, date_time, values in records:
+                the_file.write("%s;%s;%s;%s\n" % (port, probe_id, date_time, ';'.join(repr(value) for value in values)))
+
+    """ Nothing kept open
+    """
+    def close(self):
+        pass
+
+
+# null backend - drop records, pipeline measurements
+class NullBackend:
+    """ Init
+    """
+    def __init__(self, data_path):
+        pass
+
+    """ Drop records
+    """
+    def write(self, records):
+        pass
+
+    """ Nothing kept open
+    """
+    def close(self):
+        pass
+
+
+# backends by --sink name
+BACKENDS = {
+    'csv'    : CsvBackend,
+    'null'   : NullBackend,
+    'sqlite' : probe_store.Store,
+    'columns': probe_columns.ColumnarBackend,
+}
+
+""" Create a sink writing to the named backend, options for the backend
+"""
+def create_sink(name, data_path, **kwargs):
+    if name not in BACKENDS:
+        raise ValueError("unknown sink %s, one of %s" % (name, ', '.join(sorted(BACKENDS))))
+    return RecordSink(BACKENDS[name](data_path, **kwargs))
+
+
+#- ----------------------------------------------------------------------------
+#- classes
+#- ----------------------------------------------------------------------------
+# download sink - thread safe, shared by all download workers
+class RecordSink:
+    """ Init
+    """
+    def __init__(self, backend):
+        logging.debug("RecordSink init - backend: %s" % backend.__class__.__name__)
+
+        self.backend = backend
+        self.count = 0
+        # records that could not be decoded, left in the download files only
+        self.rejected = 0
+        # backend writes are serialized
+        self.lock = threading.Lock()
+
+    """ Write the validated records of a download, [(date time, values)] as built
+        by the download pipeline (bytes), in one backend write
+        return True once written, the probe pointer may then be reset
+    """
+    def put(self, port, probe_id, records):
+        # decode at the output boundary, a bad record must not block the download
+        rows = []
+        for date_time, values in records:
+            try:
+                rows.append((port, int(probe_id), date_time.decode('latin1'), tuple(float(value) for value in values)))
+            except ValueError as e:
+                logging.warning("Record of probe %s on %s at %s rejected by the sink: %s" % (probe_id.decode('latin1'), port, date_time.decode('latin1'), str(e)))
+                self.rejected += 1
+
+        with self.lock:
+            try:
+                self.backend.write(rows)
+                self.count += len(rows)
+                logging.verbose("Sink wrote %d records" % len(rows))
+                return True
+
+            except Exception as e:
+                logging.critical("An exception was encountered in RecordSink.put(): %s" % str(e))
+                return False
+
+    """ Close backend
+    """
+    def close(self):
+        logging.debug("Function RecordSink.close()")
+        with self.lock:
+            try:
+                self.backend.close()
+            except Exception as e:
+                logging.critical("An exception was encountered in RecordSink.close(): %s" % str(e))
+                return False
+        logging.info("Sink closed, %d records written, %d rejected" % (self.count, self.rejected))
+        return True
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+# ----------------------------------------------------------------------
+#  Copyright (c) 1995-2017, Ecometer s.n.c.
+#
+#  Desc : bc-electronics records store, sqlite
+#  File : probe_store.py
+# ----------------------------------------------------------------------
+""" Local records store, one row per port, probe and record time
+
+    records (port, probe_id, ts, v1 .. v6), primary key (probe_id, ts, port)
+    without rowid: rows are clustered by probe and time, a probe time range
+    is a seek on the key. Index (ts, probe_id) serves time ranges over all
+    probes. The same probe id may be used on several ports, port as tagged
+    in the download file names. Records already stored are ignored,
+    downloading twice stores once.
+
+    Used as probe_sink backend 'sqlite', or directly:
+
+    store = Store(data_path)
+    store.import_file('data/SondaID-18_COM5_20170329-140300.dat')
+    for port, probe_id, ts, values in store.query(18, '2017-03-01', '2017-04-01'):
+        ...
+"""
+
+""" Imports
+"""
+import sys
+import os
+import re
+import logging
+import sqlite3
+
+if __name__ == '__main__':
+    sys.exit(1)
+
+
+# records store - sqlite in WAL mode, thread safe when calls are serialized
+class Store:
+    """ Constants
+    """
+    DB_FILE = "probe_store.db"
+    VALUES  = 6  # value columns, max record sensors
+
+    COLUMNS = ', '.join('v%d' % (k+1) for k in range(VALUES))
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS records ("
+        " port TEXT NOT NULL,"
+        " probe_id INTEGER NOT NULL,"
+        " ts TEXT NOT NULL,"  # YYYY-MM-DD HH:MM:SS, sorts as time
+        " %s,"
+        " PRIMARY KEY (probe_id, ts, port)"
+        ") WITHOUT ROWID" % ', '.join('v%d REAL' % (k+1) for k in range(VALUES)),
+        "CREATE INDEX IF NOT EXISTS records_ts ON records (ts, probe_id)",
+    )
+    INSERT = "INSERT OR IGNORE INTO records (port, probe_id, ts, %s) VALUES (?, ?, ?, %s)" % (COLUMNS, ', '.join('?' * VALUES))
+    # SondaID-<id>_<port>_<time>.dat, no port in older files
+    RE_DOWNLOAD = re.compile(r'SondaID-\d+_(?:(\w+)_)?\d{8}-\d{6}\.dat$')
+
+    """ Init
+    """
+    def __init__(self, data_path, file_name=DB_FILE):
+        self.file_name = os.path.join(data_path, file_name)
+        logging.debug("Store init - file: %s" % self.file_name)
+
+        # writes are serialized by the caller, sink or single thread
+        self.db = sqlite3.connect(self.file_name, check_same_thread=False)
+        # readers do not block the writer, commit without fsync of the db file
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    """ Insert records in one transaction, return the number of new records
+        records: (port, probe id, 'YYYY-MM-DD HH:MM:SS', (value, ...))
+    """
+    def write(self, records):
+        pad = (None,) * self.VALUES
+        before = self.db.total_changes
+        with self.db:
+            self.db.executemany(self.INSERT, ((port, probe_id, date_time) + (tuple(values) + pad)[:self.VALUES]
+                                              for port, probe_id, date_time, values in records))
+        inserted = self.db.total_changes - before
+        logging.verbose("Stored %d records, %d new" % (len(records), inserted))
+        return inserted
+
+    """ Insert the records of a download file, id;date time;values separated by CR
+        port from the file name when not given
+    """
+    def import_file(self, file_name, port=None):
+        logging.debug("Function Store.import_file() - file: %s" % file_name)
+        if port is None:
+            matches = self.RE_DOWNLOAD.search(file_name)
+            port = matches.group(1) or '' if matches else ''
+        records = []
+        with open(file_name, 'rb') as the_file:
+            for line in the_file.read().split(b'\r'):
+                fields = line.strip().split(b';')
+                if len(fields) < 3:
+                    continue
+                records.append((port, int(fields[0]), fields[1].decode('latin1'), tuple(float(value) for value in fields[2:])))
+        return self.write(records)
+
+    """ Records in time order, optionally for one probe, one port and between start
+        (included) and end (excluded), yield (port, probe id, 'YYYY-MM-DD HH:MM:SS', (value, ...))
+    """
+    def query(self, probe_id=None, start=None, end=None, port=None):
+        where = []
+        params = []
+        if port is not None:
+            where.append("port = ?")
+            params.append(port)
+        if probe_id is not None:
+            where.append("probe_id = ?")
+            params.append(int(probe_id))
+        if start is not None:
+            where.append("ts >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("ts < ?")
+            params.append(end)
+        sql = "SELECT port, probe_id, ts, %s FROM records" % self.COLUMNS
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts, probe_id, port"
+
+        for row in self.db.execute(sql, params):
+            yield row[0], row[1], row[2], tuple(value for value in row[3:] if value is not None)
+
+    """ Time of the last stored record of a probe, on one port or any, None if none
+    """
+    def last(self, probe_id, port=None):
+        if port is None:
+            row = self.db.execute("SELECT MAX(ts) FROM records WHERE probe_id = ?", (int(probe_id),)).fetchone()
+        else:
+            row = self.db.execute("SELECT MAX(ts) FROM records WHERE port = ? AND probe_id = ?", (port, int(probe_id))).fetchone()
+        return row[0]
+
+    """ Close database
+    """
+    def close(self):
+        logging.debug("Function Store.close()")
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# http://docopt.org/
+# sudo pip3 install docopt
+#
+"""probe_trace by ecometer snc.
+
+Usage:
+    probe_trace.py <file>...
+    probe_trace.py (-h | --help)
+
+Arguments:
+    <file>          Trace dumps to print, data/SondaTrace-*.bin
+
+Options:
+    -h --help       Show this screen.
+"""
+
+""" Ring of the last raw frames sent and received on a port, kept in memory
+    by the Client at the cost of one deque append per frame, dumped to a
+    binary file on timeout, too many bcc errors or exception.
+
+    Dump: MAGIC, then per frame <time float64><direction byte><length uint16>
+    <bytes>, little endian. Directions: T command sent, R frame received,
+    X bytes received before a timeout.
+"""
+
+""" Imports
+"""
+import sys
+import os
+import re
+import time
+import struct
+import logging
+import threading
+import collections
+
+
+# frame trace - one per port
+class FrameTrace:
+    """ Constants
+    """
+    SIZE     = 2000              # frames kept
+    INTERVAL = 60                # min seconds between dumps, a dead probe times out often
+    MAGIC    = b'SA8340TRACE1\n'
+    HEADER   = struct.Struct('<dBH')
+    TX       = b'T'
+    RX       = b'R'
+    PARTIAL  = b'X'
+
+    """ Init
+    """
+    def __init__(self, data_path, port, size=SIZE, interval=INTERVAL):
+        self.data_path = data_path
+        self.tag = re.sub(r'\W', '_', str(port))
+        self.frames = collections.deque(maxlen=size)
+        self.interval = interval
+        self.dumped = 0
+        self.lock = threading.Lock()
+
+    """ Command sent (bytes)
+    """
+    def tx(self, data):
+        self.frames.append((time.time(), self.TX, data))
+
+    """ Frame received (bytes)
+    """
+    def rx(self, data):
+        self.frames.append((time.time(), self.RX, data))
+
+    """ Bytes received before a timeout, possibly none
+    """
+    def partial(self, data):
+        self.frames.append((time.time(), self.PARTIAL, bytes(data)))
+
+    """ Write frames to data/SondaTrace-<port>_<time>.bin, return file name or None
+        at most one dump every interval seconds, unless forced
+    """
+    def dump(self, reason, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.dumped < self.interval:
+                return None
+            self.dumped = now
+            frames = list(self.frames)
+
+        file_name = os.path.join(self.data_path, "SondaTrace-"+self.tag+"_"+time.strftime('%Y%m%d-%H%M%S', time.localtime(now))+".bin")
+        try:
+            with open(file_name, 'wb') as the_file:
+                the_file.write(self.MAGIC)
+                for timestamp, direction, data in frames:
+                    data = data[:0xFFFF]
+                    the_file.write(self.HEADER.pack(timestamp, ord(direction), len(data)))
+                    the_file.write(data)
+            logging.warning("Frame trace dumped to %s (%s, %d frames)" % (file_name, reason, len(frames)))
+            return file_name
+
+        except Exception as e:
+            logging.critical("An exception was encountered in FrameTrace.dump(): %s" % str(e))
+            return None
+
+
+""" Frames of a dump, (time, direction, bytes)
+"""
+def read_dump(file_name):
+    header = FrameTrace.HEADER
+    with open(file_name, 'rb') as the_file:
+        if the_file.read(len(FrameTrace.MAGIC)) != FrameTrace.MAGIC:
+            raise ValueError("%s is not a frame trace" % file_name)
+        while True:
+            data = the_file.read(header.size)
+            if len(data) < header.size:
+                return
+            timestamp, direction, length = header.unpack(data)
+            yield timestamp, chr(direction), the_file.read(length)
+
+
+""" Main script
+"""
+if __name__ == '__main__':
+
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    for file_name in args['<file>']:
+        print(file_name)
+        last = None
+        for timestamp, direction, data in read_dump(file_name):
+            # time and gap since the previous frame
+            gap = timestamp - last if last is not None else 0.0
+            last = timestamp
+            print("%s.%03d %+8.3f %s %r" % (time.strftime('%H:%M:%S', time.localtime(timestamp)), int(timestamp * 1000) % 1000, gap, direction, data))
+
+
+""" SAMPLES
+"""
+# probe_trace.py data/SondaTrace-COM5_20170329-140300.bin